@@ -0,0 +1,242 @@
+"""
+Benchmark of the evaluation stages on synthetic clustered embeddings, CPU only and without
+any dataset on disk. Every (N, classes, stage) runs in a fresh process, the RSS is sampled
+while the stage runs; the results are printed and written as JSON so two commits can be
+compared.
+
+Run from `code/`:
+    python -m benchmarks.bench_evaluation --sizes 1000 10000 100000 --classes 100 1000 \
+        --output ../logs/bench_evaluation.json
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import threading
+import time
+import multiprocessing as mp
+
+import numpy as np
+import torch
+
+stages = ['get_X_T_Y', 'calc_recall', 'get_accuracies', 'form_data_viz_frame', 'plot_node_graph']
+
+
+class SyntheticEmbeddings(torch.utils.data.Dataset):
+    """
+    nb_samples embeddings around nb_classes random unit centers (gaussian noise of std
+    `noise` in total), standing in for images with an identity model.
+    """
+    def __init__(self, nb_samples, nb_classes, sz_embedding, nb_coarse=10, noise=0.5, seed=0):
+        generator = torch.Generator().manual_seed(seed)
+        centers = torch.nn.functional.normalize(torch.randn(nb_classes, sz_embedding, generator=generator), dim=1)
+        self.ys = torch.randint(nb_classes, (nb_samples,), generator=generator)
+        self.X = centers[self.ys]
+        self.X += torch.randn(nb_samples, sz_embedding, generator=generator) * (noise / sz_embedding ** 0.5)
+
+        self.name = 'synthetic'
+        self.mode = 'eval'
+        self.class_names_fine_dict = {c: f'coarse{c % nb_coarse}_fine{c}' for c in range(nb_classes)}
+        self.class_names_coarse_dict = {c: f'coarse{c % nb_coarse}' for c in range(nb_classes)}
+
+    def nb_classes(self):
+        return len(self.class_names_fine_dict)
+
+    def __len__(self):
+        return len(self.ys)
+
+    def __getitem__(self, index):
+        return self.X[index], self.ys[index]
+
+
+class Passthrough(torch.nn.Module):
+    """ The synthetic items already are embeddings. """
+    def __init__(self):
+        super().__init__()
+        self.scale = torch.nn.Parameter(torch.ones(1), requires_grad=False)
+
+    def forward(self, x):
+        return x * self.scale
+
+
+class SkipRendering():
+    def submit(self, inputs_path):
+        pass
+
+
+def rss_mb():
+    """ Current resident set size (Linux), or the peak so far elsewhere. """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class PeakRSS():
+    """
+    Samples the RSS in a background thread while in the `with` block. ru_maxrss can't be
+    used on its own, the untimed setup of a stage may have peaked higher than the stage.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+
+    def _sample(self):
+        while not self.done.wait(self.interval):
+            self.peak = max(self.peak, rss_mb())
+
+    def __enter__(self):
+        self.peak = rss_mb()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.done.set()
+        self.thread.join()
+        self.peak = max(self.peak, rss_mb())
+
+
+def run_stage(stage, nb_samples, nb_classes, args):
+    """ Sets up everything `stage` needs (untimed), then times the stage itself. """
+    import utils
+
+    torch.set_num_threads(args.threads)
+    dataset = SyntheticEmbeddings(nb_samples, nb_classes, args.sz_embedding, args.nb_coarse, args.noise)
+    dataloader = torch.utils.data.DataLoader(dataset, batch_size=args.sz_batch, num_workers=args.nb_workers)
+    model = Passthrough()
+    run_get_X_T_Y = lambda: utils.get_X_T_Y(dataloader, model, None, chunk_size=args.chunk_size)
+
+    rng = np.random.default_rng(0)
+    result = {'stage': stage, 'nb_samples': nb_samples, 'nb_classes': nb_classes}
+    if stage != 'get_X_T_Y':
+        X, T, Y, neighbors = run_get_X_T_Y()
+        pictures_to_predict = np.sort(rng.choice(len(X), len(X) // 2, replace=False))
+    if stage in ['form_data_viz_frame', 'plot_node_graph']:
+        hierarchy, y_preds, y_true = utils.get_accuracies(T, X, dataloader, neighbors, pictures_to_predict, {})
+    if stage == 'plot_node_graph':
+        data_viz_frame = utils.form_data_viz_frame(X[pictures_to_predict], hierarchy, y_preds, y_true)
+        dest = tempfile.mkdtemp() + '/'
+
+    calls = {
+        'get_X_T_Y': run_get_X_T_Y,
+        'calc_recall': lambda: utils.calc_recall(T, Y, 7),
+        'get_accuracies': lambda: utils.get_accuracies(T, X, dataloader, neighbors, pictures_to_predict, {}),
+        'form_data_viz_frame': lambda: utils.form_data_viz_frame(X[pictures_to_predict], hierarchy,
+                                                                 y_preds, y_true),
+        'plot_node_graph': lambda: utils.plot_node_graph(X[pictures_to_predict], data_viz_frame, 'truth', 'fine',
+                                                         dest, renderer=SkipRendering()),
+    }
+
+    gc.collect()
+    result['rss_before_mb'] = rss_mb()
+    with PeakRSS() as rss:
+        start = time.perf_counter()
+        calls[stage]()
+        result['seconds'] = time.perf_counter() - start
+    result['peak_rss_mb'] = rss.peak
+    return result
+
+
+def _child(queue, stage, nb_samples, nb_classes, args):
+    try:
+        queue.put(run_stage(stage, nb_samples, nb_classes, args))
+    except Exception as e:
+        queue.put({'stage': stage, 'nb_samples': nb_samples, 'nb_classes': nb_classes,
+                   'error': f'{type(e).__name__}: {e}'})
+
+
+def run_isolated(stage, nb_samples, nb_classes, args):
+    ctx = mp.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=_child, args=(queue, stage, nb_samples, nb_classes, args))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'numpy': np.__version__,
+        'cpu_count': os.cpu_count(),
+        'machine': platform.machine(),
+    }
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark the evaluation stages on synthetic embeddings')
+    parser.add_argument('--sizes', default=[1000, 10000, 100000], type=int, nargs='+',
+                        help='Number of embeddings N (e.g. up to 1000000)'
+                        )
+    parser.add_argument('--classes', default=[100], type=int, nargs='+',
+                        help='Number of (fine) classes'
+                        )
+    parser.add_argument('--coarse-classes', default=10, type=int,
+                        dest='nb_coarse',
+                        help='Number of coarse classes the fine classes are spread over'
+                        )
+    parser.add_argument('--embedding-size', default=512, type=int,
+                        dest='sz_embedding',
+                        help='Embedding dimension'
+                        )
+    parser.add_argument('--noise', default=0.5, type=float,
+                        help='Standard deviation of the embeddings around their class center'
+                        )
+    parser.add_argument('--stages', default=stages, nargs='+', choices=stages,
+                        help='Evaluation stages to time'
+                        )
+    parser.add_argument('--batch-size', default=1024, type=int,
+                        dest='sz_batch',
+                        help='Batch size of the embedding pass'
+                        )
+    parser.add_argument('--workers', default=0, type=int,
+                        dest='nb_workers',
+                        help='DataLoader workers of the embedding pass'
+                        )
+    parser.add_argument('--chunk-size', default=4096, type=int,
+                        dest='chunk_size',
+                        help='Query rows per block of the kNN search'
+                        )
+    parser.add_argument('--threads', default=torch.get_num_threads(), type=int,
+                        help='torch intra-op threads'
+                        )
+    parser.add_argument('--output', default=None,
+                        help='JSON file to write the results to'
+                        )
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    results = []
+    print(f'{"stage":>20} {"N":>9} {"classes":>8} {"seconds":>10} {"peak RSS (MB)":>14} {"RSS before (MB)":>16}')
+    for nb_samples in args.sizes:
+        for nb_classes in args.classes:
+            for stage in args.stages:
+                result = run_isolated(stage, nb_samples, nb_classes, args)
+                results.append(result)
+                if 'error' in result:
+                    print(f'{stage:>20} {nb_samples:>9} {nb_classes:>8}  {result["error"]}')
+                else:
+                    print(f'{stage:>20} {nb_samples:>9} {nb_classes:>8} {result["seconds"]:>10.3f} '
+                          f'{result["peak_rss_mb"]:>14.1f} {result["rss_before_mb"]:>16.1f}')
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump({'environment': environment(), 'arguments': vars(args), 'results': results}, f, indent=2)
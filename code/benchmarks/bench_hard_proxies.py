@@ -0,0 +1,144 @@
+"""
+Step time and Recall@1 of Proxy_Anchor with every proxy against hard proxy sub-sampling
+(--hard-proxies in train.py), on synthetic clustered data and a linear embedding, CPU only.
+
+Run from `code/`:
+    python -m benchmarks.bench_hard_proxies --classes 1000 10000 100000 --hard-negatives 100 1000 \
+        --output ../logs/bench_hard_proxies.json
+"""
+import argparse
+import json
+import os
+import time
+
+import torch
+import torch.nn.functional as F
+
+import losses
+from utils import topk_neighbours
+
+
+class SyntheticClasses():
+    """ Inputs of `nb_classes` classes scattered (std `noise` in total) around random unit centers. """
+    def __init__(self, nb_classes, sz_input, noise, seed=0):
+        self.generator = torch.Generator().manual_seed(seed)
+        self.centers = F.normalize(torch.randn(nb_classes, sz_input, generator=self.generator), dim=1)
+        self.noise = noise / sz_input ** 0.5
+
+    def sample(self, labels):
+        return self.centers[labels] + torch.randn(len(labels), self.centers.shape[1], generator=self.generator) * self.noise
+
+    def batch(self, sz_batch):
+        labels = torch.randint(len(self.centers), (sz_batch,), generator=self.generator)
+        return self.sample(labels), labels
+
+
+def recall_at_1(model, data, nb_classes, per_class=5):
+    labels = torch.arange(nb_classes).repeat_interleave(per_class)
+    with torch.no_grad():
+        X = F.normalize(model(data.sample(labels)), dim=1)
+    neighbours = topk_neighbours(X, 1)[:, 0]
+    return (labels[neighbours] == labels).float().mean().item() * 100
+
+
+def run(nb_classes, hard_negatives, proxy_index, args):
+    torch.manual_seed(0)
+    data = SyntheticClasses(nb_classes, args.sz_input, args.noise)
+    model = torch.nn.Linear(args.sz_input, args.sz_embedding)
+    criterion = losses.Proxy_Anchor(nb_classes, args.sz_embedding, hard_negatives=hard_negatives,
+                                    refresh_every=args.refresh_every, proxy_index=proxy_index)
+    opt = torch.optim.AdamW([{'params': model.parameters(), 'lr': args.lr},
+                             {'params': criterion.parameters(), 'lr': args.lr * 100}])
+
+    step_times = []
+    for step in range(args.steps):
+        x, y = data.batch(args.sz_batch)
+        start = time.perf_counter()
+        loss = criterion(model(x), y)
+        opt.zero_grad()
+        loss.backward()
+        opt.step()
+        step_times.append(time.perf_counter() - start)
+
+    timed = sorted(step_times[args.warmup:])
+    return {
+        'nb_classes': nb_classes,
+        'hard_negatives': hard_negatives,
+        'proxy_index': proxy_index if hard_negatives else None,
+        'median_step_seconds': timed[len(timed) // 2],
+        'mean_step_seconds': sum(timed) / len(timed),
+        'final_loss': loss.item(),
+        'recall@1': recall_at_1(model, data, min(nb_classes, args.eval_classes)),
+    }
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark hard proxy sub-sampling of Proxy_Anchor')
+    parser.add_argument('--classes', default=[1000, 10000, 100000], type=int, nargs='+',
+                        help='Number of classes (proxies)'
+                        )
+    parser.add_argument('--hard-negatives', default=[100, 1000], type=int, nargs='+',
+                        dest='hard_negatives',
+                        help='Numbers of hard negative proxies to compare with the full loss'
+                        )
+    parser.add_argument('--proxy-index', default=['flat', 'ivf'], nargs='+', choices=['flat', 'ivf'],
+                        dest='proxy_index',
+                        help='Indexes the hard negatives are searched in'
+                        )
+    parser.add_argument('--refresh-every', default=200, type=int,
+                        dest='refresh_every',
+                        help='Steps between rebuilds of the proxy index'
+                        )
+    parser.add_argument('--steps', default=300, type=int,
+                        help='Training steps per configuration'
+                        )
+    parser.add_argument('--warmup', default=10, type=int,
+                        help='First steps left out of the step time'
+                        )
+    parser.add_argument('--batch-size', default=150, type=int,
+                        dest='sz_batch',
+                        help='Batch size'
+                        )
+    parser.add_argument('--input-size', default=64, type=int,
+                        dest='sz_input',
+                        help='Dimension of the synthetic inputs'
+                        )
+    parser.add_argument('--embedding-size', default=128, type=int,
+                        dest='sz_embedding',
+                        help='Embedding dimension'
+                        )
+    parser.add_argument('--noise', default=1.5, type=float,
+                        help='Standard deviation of the inputs around their class center'
+                        )
+    parser.add_argument('--lr', default=1e-3, type=float,
+                        help='Learning rate of the embedding, the proxies use 100 times more as in train.py'
+                        )
+    parser.add_argument('--eval-classes', default=2000, type=int,
+                        dest='eval_classes',
+                        help='Number of classes Recall@1 is measured on (5 samples each)'
+                        )
+    parser.add_argument('--output', default=None,
+                        help='JSON file to write the results to'
+                        )
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    results = []
+    print(f'{"classes":>8} {"hard":>6} {"index":>6} {"step (ms)":>10} {"Recall@1":>9} {"loss":>8}')
+    for nb_classes in args.classes:
+        configs = [(0, 'flat')] + [(M, index) for M in args.hard_negatives if M < nb_classes
+                                   for index in args.proxy_index]
+        for hard_negatives, proxy_index in configs:
+            result = run(nb_classes, hard_negatives, proxy_index, args)
+            results.append(result)
+            print(f'{nb_classes:>8} {hard_negatives or "all":>6} {result["proxy_index"] or "-":>6} '
+                  f'{result["median_step_seconds"] * 1000:>10.2f} {result["recall@1"]:>9.2f} '
+                  f'{result["final_loss"]:>8.3f}')
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump({'arguments': vars(args), 'results': results}, f, indent=2)
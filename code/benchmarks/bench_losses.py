@@ -0,0 +1,208 @@
+"""
+Forward + backward cost of the criteria of losses.py on synthetic embeddings, CPU only.
+Every (loss, batch size, embedding size, classes) runs in a fresh process with the RSS
+sampled while it steps; the time spent in the miner of MS and Triplet is reported on its own.
+The comparison table is printed and written as JSON, pass an earlier JSON as --baseline to
+get the speedup of every configuration against it.
+
+Run from `code/`:
+    python -m benchmarks.bench_losses --batch-sizes 60 150 300 --embedding-sizes 128 512 \
+        --classes 100 1000 10000 --output ../logs/bench_losses.json
+"""
+import argparse
+import gc
+import json
+import os
+import time
+import multiprocessing as mp
+
+import torch
+
+from benchmarks.bench_evaluation import PeakRSS, environment, rss_mb
+
+loss_names = ['Proxy_Anchor', 'Proxy_NCA', 'MS', 'Contrastive', 'Triplet', 'NPair']
+
+
+def create_loss(name, nb_classes, sz_embedding):
+    # same defaults as create_loss in train.py
+    import losses
+    if name == 'Proxy_Anchor':
+        return losses.Proxy_Anchor(nb_classes=nb_classes, sz_embed=sz_embedding)
+    elif name == 'Proxy_NCA':
+        return losses.Proxy_NCA(nb_classes=nb_classes, sz_embed=sz_embedding)
+    elif name == 'MS':
+        return losses.MultiSimilarityLoss()
+    elif name == 'Contrastive':
+        return losses.ContrastiveLoss()
+    elif name == 'Triplet':
+        return losses.TripletLoss()
+    elif name == 'NPair':
+        return losses.NPairLoss()
+
+
+class TimedMiner(torch.nn.Module):
+    """ Wraps a criterion's miner and sums the time spent in it. """
+    def __init__(self, miner):
+        super().__init__()
+        self.miner = miner
+        self.seconds = 0
+
+    def forward(self, *args, **kwargs):
+        start = time.perf_counter()
+        pairs = self.miner(*args, **kwargs)
+        self.seconds += time.perf_counter() - start
+        return pairs
+
+
+def synthetic_batch(sz_batch, nb_classes, sz_embedding, samples_per_class, generator):
+    """ sz_batch random embeddings of sz_batch / samples_per_class classes, as the balanced sampler draws them. """
+    nb_batch_classes = max(sz_batch // samples_per_class, 1)
+    if nb_batch_classes <= nb_classes:
+        classes = torch.randperm(nb_classes, generator=generator)[:nb_batch_classes]
+    else:
+        classes = torch.randint(nb_classes, (nb_batch_classes,), generator=generator)
+    labels = classes.repeat_interleave(samples_per_class)[:sz_batch]
+    embeddings = torch.randn(len(labels), sz_embedding, generator=generator)
+    return embeddings.requires_grad_(), labels
+
+
+def median(values):
+    return sorted(values)[len(values) // 2]
+
+
+def run_config(name, sz_batch, sz_embedding, nb_classes, args):
+    """ Sets up the criterion and the batches (untimed), then times `args.steps` forward + backward passes. """
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    generator = torch.Generator().manual_seed(0)
+    criterion = create_loss(name, nb_classes, sz_embedding)
+    miner = None
+    if hasattr(criterion, 'miner'):
+        miner = criterion.miner = TimedMiner(criterion.miner)
+    batches = [synthetic_batch(sz_batch, nb_classes, sz_embedding, args.samples_per_class, generator)
+               for _ in range(args.warmup + args.steps)]
+
+    step_times, miner_times = [], []
+    gc.collect()
+    result = {'loss': name, 'sz_batch': sz_batch, 'sz_embedding': sz_embedding, 'nb_classes': nb_classes,
+              'rss_before_mb': rss_mb()}
+    with PeakRSS() as rss:
+        for step, (embeddings, labels) in enumerate(batches):
+            criterion.zero_grad(set_to_none=True)
+            embeddings.grad = None
+            if miner is not None:
+                miner.seconds = 0
+            start = time.perf_counter()
+            loss = criterion(embeddings, labels)
+            loss.backward()
+            if step >= args.warmup:
+                step_times.append(time.perf_counter() - start)
+                miner_times.append(miner.seconds if miner is not None else 0)
+
+    result.update({
+        'median_step_seconds': median(step_times),
+        'mean_step_seconds': sum(step_times) / len(step_times),
+        'median_miner_seconds': median(miner_times) if miner is not None else None,
+        'peak_rss_mb': rss.peak,
+        'final_loss': loss.item(),
+    })
+    return result
+
+
+def _child(queue, name, sz_batch, sz_embedding, nb_classes, args):
+    try:
+        queue.put(run_config(name, sz_batch, sz_embedding, nb_classes, args))
+    except Exception as e:
+        queue.put({'loss': name, 'sz_batch': sz_batch, 'sz_embedding': sz_embedding, 'nb_classes': nb_classes,
+                   'error': f'{type(e).__name__}: {e}'})
+
+
+def run_isolated(name, sz_batch, sz_embedding, nb_classes, args):
+    ctx = mp.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=_child, args=(queue, name, sz_batch, sz_embedding, nb_classes, args))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def config_key(result):
+    return result['loss'], result['sz_batch'], result['sz_embedding'], result['nb_classes']
+
+
+def load_baseline(path):
+    with open(path) as f:
+        return {config_key(result): result for result in json.load(f)['results'] if 'error' not in result}
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark the criteria of losses.py on synthetic embeddings')
+    parser.add_argument('--losses', default=loss_names, nargs='+', choices=loss_names,
+                        help='Criteria to time'
+                        )
+    parser.add_argument('--batch-sizes', default=[60, 150, 300], type=int, nargs='+',
+                        dest='batch_sizes',
+                        help='Batch sizes'
+                        )
+    parser.add_argument('--embedding-sizes', default=[128, 512], type=int, nargs='+',
+                        dest='embedding_sizes',
+                        help='Embedding dimensions'
+                        )
+    parser.add_argument('--classes', default=[100, 1000, 10000], type=int, nargs='+',
+                        help='Number of classes (proxies of the proxy based losses)'
+                        )
+    parser.add_argument('--samples-per-class', default=3, type=int,
+                        dest='samples_per_class',
+                        help='Items per class in a batch, as --IPC in train.py'
+                        )
+    parser.add_argument('--steps', default=20, type=int,
+                        help='Timed forward + backward passes per configuration'
+                        )
+    parser.add_argument('--warmup', default=3, type=int,
+                        help='Untimed passes before them'
+                        )
+    parser.add_argument('--threads', default=torch.get_num_threads(), type=int,
+                        help='torch intra-op threads'
+                        )
+    parser.add_argument('--baseline', default=None,
+                        help='JSON written by an earlier run to report the speedup against'
+                        )
+    parser.add_argument('--output', default=None,
+                        help='JSON file to write the results to'
+                        )
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    baseline = load_baseline(args.baseline) if args.baseline else {}
+
+    results = []
+    print(f'{"loss":>12} {"batch":>6} {"embed":>6} {"classes":>8} {"step (ms)":>10} {"miner (ms)":>11} '
+          f'{"peak RSS (MB)":>14}' + (f' {"speedup":>8}' if baseline else ''))
+    for name in args.losses:
+        for sz_batch in args.batch_sizes:
+            for sz_embedding in args.embedding_sizes:
+                for nb_classes in args.classes:
+                    result = run_isolated(name, sz_batch, sz_embedding, nb_classes, args)
+                    results.append(result)
+                    row = f'{name:>12} {sz_batch:>6} {sz_embedding:>6} {nb_classes:>8}'
+                    if 'error' in result:
+                        print(f'{row}  {result["error"]}')
+                        continue
+                    miner = result['median_miner_seconds']
+                    row += f' {result["median_step_seconds"] * 1000:>10.2f} ' + \
+                           (f'{miner * 1000:>11.2f}' if miner is not None else f'{"-":>11}') + \
+                           f' {result["peak_rss_mb"]:>14.1f}'
+                    if baseline:
+                        before = baseline.get(config_key(result))
+                        result['speedup'] = before['median_step_seconds'] / result['median_step_seconds'] \
+                            if before else None
+                        row += f' {result["speedup"]:>7.2f}x' if before else f' {"-":>8}'
+                    print(row)
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump({'environment': environment(), 'arguments': vars(args), 'results': results}, f, indent=2)
@@ -0,0 +1,71 @@
+"""
+Micro-benchmark of similarity.pairwise_similarity against the per-element Python loop that
+utils.cosine_similarity used to be.
+
+Run from `code/`:
+    python -m benchmarks.bench_similarity --sizes 256 1024 4096 --embedding-size 512
+"""
+import argparse
+import math
+import time
+
+import torch
+
+from similarity import pairwise_similarity
+
+
+def loop_cosine_similarity(v1, v2):
+    "compute cosine similarity of v1 to v2: (v1 dot v2)/{||v1||*||v2||)"
+    sumxx, sumxy, sumyy = 0, 0, 0
+    for i in range(len(v1)):
+        x = v1[i]
+        y = v2[i]
+        sumxx += x * x
+        sumyy += y * y
+        sumxy += x * y
+    return sumxy / math.sqrt(sumxx * sumyy)
+
+
+def time_call(fn, repeats):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark batched pairwise similarity')
+    parser.add_argument('--sizes', default=[256, 1024, 4096], type=int, nargs='+',
+                        help='Number of rows n of the n x n similarity matrix'
+                        )
+    parser.add_argument('--embedding-size', default=512, type=int,
+                        dest='sz_embedding',
+                        help='Embedding dimension'
+                        )
+    parser.add_argument('--loop-pairs', default=200, type=int,
+                        help='Number of pairs timed with the Python loop (extrapolated to n x n)'
+                        )
+    parser.add_argument('--repeats', default=3, type=int,
+                        help='Repeats per measurement, the fastest is reported'
+                        )
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    torch.manual_seed(0)
+
+    X = torch.randn(args.loop_pairs, args.sz_embedding)
+    rows = X.tolist()
+    loop_time = time_call(lambda: [loop_cosine_similarity(rows[i], rows[-i - 1]) for i in range(len(rows))],
+                          args.repeats) / len(rows)
+
+    print(f'{"n":>8} {"loop (s, extrapolated)":>24} {"float32 (s)":>12} {"bfloat16 (s)":>13} {"max |err| bf16":>15}')
+    for n in args.sizes:
+        X = torch.randn(n, args.sz_embedding)
+        fp32_time = time_call(lambda: pairwise_similarity(X), args.repeats)
+        bf16_time = time_call(lambda: pairwise_similarity(X, compute_dtype=torch.bfloat16), args.repeats)
+        err = (pairwise_similarity(X) - pairwise_similarity(X, compute_dtype=torch.bfloat16)).abs().max().item()
+        print(f'{n:>8} {loop_time * n * n:>24.3f} {fp32_time:>12.5f} {bf16_time:>13.5f} {err:>15.4f}')
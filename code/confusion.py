@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+
+class ConfusionCounts():
+    """
+    Sparse confusion matrix (rows: true labels, columns: predicted labels) over a label
+    vocabulary that grows with every update. Only observed (truth, prediction) pairs take
+    memory, so it stays small for tens of thousands of classes. Counts of different batches
+    or processes are combined with `merge` (or +), e.g. after `load`ing what others `save`d.
+    """
+    def __init__(self, labels=None):
+        self.labels = pd.Index([] if labels is None else list(labels))
+        self.counts = sp.csr_matrix((len(self.labels), len(self.labels)), dtype=np.int64)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def _codes(self, labels):
+        labels = np.asarray(labels)
+        new = pd.Index(pd.unique(labels)).difference(self.labels, sort=False)
+        if len(new):
+            self.labels = self.labels.append(new)
+            self.counts.resize((len(self.labels), len(self.labels)))
+        return self.labels.get_indexer(labels)
+
+    def _add(self, rows, cols, counts):
+        self.counts = self.counts + sp.csr_matrix((counts, (rows, cols)), shape=self.counts.shape, dtype=np.int64)
+
+    def update(self, truth, prediction):
+        return self.update_codes(self._codes(truth), self._codes(prediction))
+
+    def update_codes(self, truth, prediction):
+        """ Same as update, for labels given as positions in self.labels. """
+        self._add(truth, prediction, np.ones(len(truth), dtype=np.int64))
+        return self
+
+    def merge(self, other):
+        coo = other.counts.tocoo()
+        codes = self._codes(other.labels)
+        self._add(codes[coo.row], codes[coo.col], coo.data)
+        return self
+
+    def __add__(self, other):
+        return ConfusionCounts(self.labels).merge(self).merge(other)
+
+    def dense(self):
+        return self.counts.toarray()
+
+    def top_confusions(self, n=20):
+        """
+        The n most frequent wrong (truth, prediction) pairs, with the share of the true
+        label's items that received that prediction.
+        """
+        coo = self.counts.tocoo()
+        wrong = coo.row != coo.col
+        rows, cols, counts = coo.row[wrong], coo.col[wrong], coo.data[wrong]
+        top = np.lexsort((cols, rows, -counts))[:n]
+        support = np.asarray(self.counts.sum(axis=1)).ravel()
+        return pd.DataFrame({
+            'truth': self.labels[rows[top]],
+            'prediction': self.labels[cols[top]],
+            'count': counts[top],
+            'share_of_truth': counts[top] / support[rows[top]],
+        })
+
+    def save(self, path):
+        coo = self.counts.tocoo()
+        np.savez(path, labels=np.asarray(self.labels), rows=coo.row, cols=coo.col, counts=coo.data)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=True) as saved:
+            confusion = cls(saved['labels'])
+            confusion._add(saved['rows'], saved['cols'], saved['counts'])
+        return confusion
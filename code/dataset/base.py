@@ -6,8 +6,46 @@ import os
 import torch
 import torchvision
 import numpy as np
+import pandas as pd
 import PIL.Image
 
+class LabelHierarchy():
+    """
+    Integer coded label levels of a dataset. For every level ('fine', 'coarse' and, for
+    note_styles, 'denom'):
+        names[level]    sorted vocabulary of the level
+        codes[level]    int32 [max class id + 1] lookup, class id (ys) -> index into names[level],
+                        -1 for ids without a name
+    so the labels of any array of class ids are codes[level][ys], no string work per row.
+    """
+    def __init__(self, fine_dict, coarse_dict, with_denom=False):
+        levels = {'fine': fine_dict, 'coarse': coarse_dict}
+        if with_denom:
+            levels['denom'] = {y: name.split('_')[0] for y, name in fine_dict.items()}
+
+        nb_ids = max(int(y) for y in fine_dict) + 1 if len(fine_dict) else 0
+        self.names, self.codes = {}, {}
+        for level, names in levels.items():
+            ids = np.fromiter((int(y) for y in names), dtype=np.int64, count=len(names))
+            self.names[level], codes = np.unique(np.array(list(names.values()), dtype=str), return_inverse=True)
+            self.codes[level] = np.full(nb_ids, -1, dtype=np.int32)
+            self.codes[level][ids] = codes
+
+    @property
+    def levels(self):
+        return list(self.names)
+
+    def encode(self, ys, level):
+        """ Codes of class ids `ys` at `level`, -1 for ids the dataset doesn't know. """
+        ys = np.asarray(ys).astype(np.int64)
+        known = (ys >= 0) & (ys < len(self.codes[level]))
+        return np.where(known, self.codes[level][np.where(known, ys, 0)], -1).astype(np.int32)
+
+    def categorical(self, ys, level):
+        """ Labels of class ids `ys` at `level` as a pandas Categorical (NaN for unknown ids). """
+        return pd.Categorical.from_codes(self.encode(ys, level), categories=self.names[level])
+
+
 class BaseDataset(torch.utils.data.Dataset):
     def __init__(self, root, mode, transform = None):
         self.root = root
@@ -19,6 +57,13 @@ class BaseDataset(torch.utils.data.Dataset):
         assert set(self.ys) == set(self.classes)
         return len(self.classes)
 
+    @property
+    def hierarchy(self):
+        if getattr(self, '_hierarchy', None) is None:
+            self._hierarchy = LabelHierarchy(self.class_names_fine_dict, self.class_names_coarse_dict,
+                                             with_denom=self.name == 'note_styles')
+        return self._hierarchy
+
     def __len__(self):
         return len(self.ys)
 
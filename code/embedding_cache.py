@@ -0,0 +1,123 @@
+import os
+import time
+import hashlib
+import sqlite3
+
+import numpy as np
+
+
+def model_fingerprint(model):
+    """ sha1 over the names, shapes and values of every tensor in the model's state_dict. """
+    h = hashlib.sha1()
+    for name, tensor in model.state_dict().items():
+        h.update(name.encode())
+        h.update(str(tuple(tensor.shape)).encode())
+        h.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+
+def image_fingerprint(im_path, hash_content=False):
+    """
+    Identifies an image file by path, size and modification time, or by the sha1 of its bytes
+    if `hash_content` is set (slower, but survives copies and touch).
+    """
+    if hash_content:
+        h = hashlib.sha1()
+        with open(im_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        return h.hexdigest()
+    stat = os.stat(im_path)
+    return f'{os.path.abspath(im_path)}:{stat.st_size}:{stat.st_mtime_ns}'
+
+
+_random_transforms = ['ColorJitter', 'GaussianBlur', 'ElasticTransform', 'AutoAugment', 'RandAugment',
+                      'TrivialAugmentWide', 'AugMix']
+
+
+def is_deterministic(transform):
+    """ False if `transform`, or any step of a Compose, draws random augmentations (torchvision Random*, ...). """
+    name = type(transform).__name__
+    if name.startswith('Random') or name in _random_transforms:
+        return False
+    return all(is_deterministic(step) for step in getattr(transform, 'transforms', []))
+
+
+def transform_fingerprint(transform):
+    """
+    Description of `transform` that is the same in every process: class names and parameters,
+    through Compose and the like. repr() isn't, objects without their own __repr__ (Identity,
+    RGBToBGR, ...) print their memory address.
+    """
+    steps = getattr(transform, 'transforms', None)
+    if isinstance(steps, (list, tuple)):
+        return f'{type(transform).__name__}({", ".join(transform_fingerprint(step) for step in steps)})'
+    if type(transform).__repr__ is object.__repr__:
+        params = ', '.join(f'{key}={transform_fingerprint(value)}'
+                           for key, value in sorted(getattr(transform, '__dict__', {}).items()))
+        return f'{type(transform).__name__}({params})'
+    return repr(transform)
+
+
+class EmbeddingCache():
+    """
+    Content-addressed, LRU-evicted on-disk cache of single image embeddings.
+
+    An entry is keyed by sha1(model fingerprint, transform, image fingerprint), so new weights,
+    a different transform or a modified image file all miss. Entries live in one sqlite file;
+    once more than `max_entries` are stored the least recently used ones are dropped.
+    Only for deterministic (evaluation) transforms, `keys` refuses datasets with random augmentation.
+    """
+    def __init__(self, path, max_entries=1000000, hash_content=False):
+        self.path = path
+        self.max_entries = max_entries
+        self.hash_content = hash_content
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS embeddings '
+                        '(key TEXT PRIMARY KEY, embedding BLOB, last_used REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS last_used_idx ON embeddings (last_used)')
+        self.db.commit()
+
+    def keys(self, model, dataset):
+        transform = getattr(dataset, 'transform', None)
+        if not is_deterministic(transform):
+            raise ValueError(f'Can not cache embeddings of a randomly augmented dataset: {transform}')
+        prefix = model_fingerprint(model) + transform_fingerprint(transform)
+        return [hashlib.sha1((prefix + image_fingerprint(im_path, self.hash_content)).encode()).hexdigest()
+                for im_path in dataset.im_paths]
+
+    def get_many(self, keys, batch_sz=500):
+        """ Returns {key: float32 embedding} for every key in the cache and marks them as used. """
+        found = {}
+        for start in range(0, len(keys), batch_sz):
+            batch = keys[start:start + batch_sz]
+            rows = self.db.execute('SELECT key, embedding FROM embeddings WHERE key IN ({})'.format(
+                ','.join('?' * len(batch))), batch).fetchall()
+            for key, embedding in rows:
+                found[key] = np.frombuffer(embedding, dtype=np.float32)
+
+        now = time.time()
+        self.db.executemany('UPDATE embeddings SET last_used = ? WHERE key = ?', [(now, key) for key in found])
+        self.db.commit()
+        return found
+
+    def put_many(self, keys, embeddings):
+        now = time.time()
+        self.db.executemany('INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)',
+                            [(key, np.asarray(embedding, dtype=np.float32).tobytes(), now)
+                             for key, embedding in zip(keys, embeddings)])
+        self.db.commit()
+        self.evict()
+
+    def evict(self):
+        nb_entries = self.db.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+        if nb_entries > self.max_entries:
+            self.db.execute('DELETE FROM embeddings WHERE key IN '
+                            '(SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)',
+                            (nb_entries - self.max_entries,))
+            self.db.commit()
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
@@ -0,0 +1,92 @@
+import os
+import json
+
+import numpy as np
+
+
+class EmbeddingStore():
+    """
+    On-disk store of evaluation embeddings.
+
+    Every entry is keyed by (checkpoint, dataset name, mode) and lives in
+    `root/<dataset>/<checkpoint>/<mode>/` as
+        X.f32          raw float32 [nb_samples x sz_embedding], opened with np.memmap
+        T.npy          int64 labels, opened with mmap_mode='r'
+        im_paths.json  image path of every row (optional)
+    `root/manifest.json` lists all entries with their shapes so other scripts can
+    find a snapshot without re-running the backbone.
+    """
+    manifest_name = 'manifest.json'
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    @staticmethod
+    def key(checkpoint, dataset_name, mode):
+        return f'{dataset_name}/{checkpoint}/{mode}'
+
+    def path(self, checkpoint, dataset_name, mode):
+        return os.path.join(self.root, dataset_name, str(checkpoint), mode)
+
+    def manifest(self):
+        manifest_path = os.path.join(self.root, self.manifest_name)
+        if not os.path.exists(manifest_path):
+            return {}
+        with open(manifest_path) as f:
+            return json.load(f)
+
+    def _write_manifest(self, manifest):
+        manifest_path = os.path.join(self.root, self.manifest_name)
+        tmp_path = manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, manifest_path)
+
+    def has(self, checkpoint, dataset_name, mode):
+        return self.key(checkpoint, dataset_name, mode) in self.manifest()
+
+    def save(self, checkpoint, dataset_name, mode, X, T, im_paths=None):
+        dest = self.path(checkpoint, dataset_name, mode)
+        os.makedirs(dest, exist_ok=True)
+
+        X = np.asarray(X, dtype=np.float32)
+        X_mm = np.memmap(os.path.join(dest, 'X.f32'), dtype=np.float32, mode='w+', shape=X.shape)
+        X_mm[:] = X
+        X_mm.flush()
+        del X_mm
+
+        np.save(os.path.join(dest, 'T.npy'), np.asarray(T, dtype=np.int64))
+        if im_paths is not None:
+            with open(os.path.join(dest, 'im_paths.json'), 'w') as f:
+                json.dump([str(p) for p in im_paths], f)
+
+        manifest = self.manifest()
+        manifest[self.key(checkpoint, dataset_name, mode)] = {
+            'checkpoint': str(checkpoint),
+            'dataset': dataset_name,
+            'mode': mode,
+            'nb_samples': int(X.shape[0]),
+            'sz_embedding': int(X.shape[1]),
+            'dtype': 'float32',
+            'has_im_paths': im_paths is not None,
+        }
+        self._write_manifest(manifest)
+
+    def load(self, checkpoint, dataset_name, mode):
+        """
+        Returns X (read-only np.memmap), T (read-only memmapped array) and the image paths
+        (None if they weren't stored).
+        """
+        entry = self.manifest()[self.key(checkpoint, dataset_name, mode)]
+        src = self.path(checkpoint, dataset_name, mode)
+
+        X = np.memmap(os.path.join(src, 'X.f32'), dtype=np.float32, mode='r',
+                      shape=(entry['nb_samples'], entry['sz_embedding']))
+        T = np.load(os.path.join(src, 'T.npy'), mmap_mode='r')
+
+        im_paths = None
+        if entry['has_im_paths']:
+            with open(os.path.join(src, 'im_paths.json')) as f:
+                im_paths = json.load(f)
+        return X, T, im_paths
@@ -0,0 +1,134 @@
+import queue
+import traceback
+
+import torch
+import torch.multiprocessing as mp
+
+import plots
+
+
+def snapshot(module):
+    """ CPU copy of a module's state_dict that can be sent to another process. """
+    return {key: val.detach().cpu().clone() for key, val in module.state_dict().items()}
+
+
+def _loader_settings(dataloader):
+    if dataloader is None:
+        return None
+    return dataloader.dataset, dataloader.batch_size, dataloader.num_workers
+
+
+def _evaluate_forever(tasks, results, args, loader_settings):
+    # imported here so the evaluation process sets up its own globals (args, model, criterion)
+    import train
+    train.args = args
+
+    dataloaders = [None if settings is None else torch.utils.data.DataLoader(
+        settings[0],
+        batch_size=settings[1],
+        shuffle=False,
+        num_workers=settings[2],
+        pin_memory=True
+    ) for settings in loader_settings]
+    dl_tr, dl_val, dl_ev, dl_query, dl_gallery = dataloaders
+
+    model = train.create_model()
+    criterion = train.create_loss(dl_tr.dataset.nb_classes())
+    train.model, train.criterion = model, criterion
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        epoch, model_state, criterion_state = task
+        model.load_state_dict(model_state)
+        criterion.load_state_dict(criterion_state)
+        try:
+            val_recalls, test_recalls = train.evaluate_epoch(model, epoch, args, dl_tr, dl_val, dl_ev,
+                                                             dl_query, dl_gallery)
+            results.put((epoch, val_recalls, test_recalls, None))
+        except Exception:
+            results.put((epoch, None, None, traceback.format_exc()))
+
+    plots.close_renderer()
+
+
+class EvaluationWorker():
+    """
+    Runs train.evaluate_epoch in a separate process so training doesn't wait for it.
+
+    `submit` sends a CPU snapshot of the model and criterion (proxies) weights. At most
+    `max_pending` snapshots wait in the queue; submitting more blocks until the worker
+    catches up, or returns False if the worker has exited (e.g. it failed to set up or ran
+    out of memory) so the caller can evaluate inline instead. `poll` returns the finished evaluations as
+    (epoch, val_recalls, test_recalls, model state_dict) so the caller can log them and keep
+    the best checkpoint.
+    """
+    def __init__(self, args, dataloaders, max_pending=1):
+        ctx = mp.get_context('spawn')
+        self.tasks = ctx.Queue(maxsize=max_pending)
+        self.results = ctx.Queue()
+        self.snapshots = {}
+        # not a daemon: the evaluation DataLoaders may start worker processes of their own
+        self.process = ctx.Process(target=_evaluate_forever,
+                                   args=(self.tasks, self.results, args,
+                                         [_loader_settings(dl) for dl in dataloaders]))
+        self.process.start()
+
+    def submit(self, epoch, model, criterion, timeout=10):
+        """ Queues the evaluation of epoch; False (nothing queued) if the evaluation process has exited. """
+        task = (epoch, snapshot(model), snapshot(criterion))
+        # a bounded put would block forever once the worker is gone, so recheck it every `timeout` seconds
+        while self.process.is_alive():
+            try:
+                self.tasks.put(task, timeout=timeout)
+            except queue.Full:
+                continue
+            self.snapshots[epoch] = task[1]
+            return True
+        print(f'WARNING: evaluation process exited (exit code {self.process.exitcode})')
+        return False
+
+    def _finished(self, epoch, val_recalls, test_recalls, error):
+        state_dict = self.snapshots.pop(epoch)
+        if error is not None:
+            print(f'WARNING: evaluation of epoch {epoch} failed')
+            print(error)
+            return None
+        return epoch, val_recalls, test_recalls, state_dict
+
+    def poll(self):
+        finished = []
+        while True:
+            try:
+                result = self.results.get_nowait()
+            except queue.Empty:
+                break
+            result = self._finished(*result)
+            if result is not None:
+                finished.append(result)
+        return finished
+
+    def close(self):
+        """ Waits for every submitted evaluation and returns the ones not polled yet. """
+        finished = []
+        while self.snapshots:
+            if not self.process.is_alive() and self.results.empty():
+                print('WARNING: evaluation process exited with pending evaluations')
+                break
+            try:
+                result = self._finished(*self.results.get(timeout=10))
+            except queue.Empty:
+                continue
+            if result is not None:
+                finished.append(result)
+        while self.process.is_alive():
+            try:
+                self.tasks.put(None, timeout=10)
+                break
+            except queue.Full:
+                continue
+        if not self.process.is_alive():
+            self.tasks.cancel_join_thread()  # nobody reads the queue anymore, don't wait for it to flush
+        self.process.join()
+        return finished
@@ -0,0 +1,69 @@
+import os
+import uuid
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+class FrameStore():
+    """
+    Append-only Parquet store of the per-epoch evaluation frames (metrics, prediction frames).
+
+    Every frame `name` is a hive partitioned dataset
+        root/<name>/run=<run>/epoch=<epoch>/mode=<mode>/<uuid>.parquet
+    so appending never rewrites earlier files and `read` scans every run and epoch at once.
+    String columns are stored dictionary-encoded and float64 columns as float32.
+    """
+    def __init__(self, root, run):
+        assert pa is not None, 'FrameStore needs pyarrow (pip install pyarrow)'
+        self.root = root
+        self.run = run
+
+    def path(self, name, epoch, mode):
+        return os.path.join(self.root, name, f'run={self.run}', f'epoch={epoch}', f'mode={mode}')
+
+    @staticmethod
+    def _compact(frame):
+        frame = frame.reset_index(drop=True)
+        for col in frame.columns:
+            if frame[col].dtype == np.float64:
+                frame[col] = frame[col].astype(np.float32)
+            elif pd.api.types.is_object_dtype(frame[col]) or pd.api.types.is_string_dtype(frame[col]):
+                frame[col] = frame[col].astype(str).astype('category')
+        return frame
+
+    def append(self, name, frame, epoch, mode):
+        dest = self.path(name, epoch, mode)
+        os.makedirs(dest, exist_ok=True)
+        table = pa.Table.from_pandas(self._compact(frame), preserve_index=False)
+        # same dictionary index type in every file, whatever the number of labels, so files stay mergeable
+        table = table.cast(pa.schema([pa.field(field.name, pa.dictionary(pa.int32(), pa.string()))
+                                      if pa.types.is_dictionary(field.type) else field
+                                      for field in table.schema], metadata=table.schema.metadata))
+        pq.write_table(table, os.path.join(dest, f'{uuid.uuid4().hex}.parquet'), compression='zstd')
+
+    def read(self, name, columns=None, **partitions):
+        """
+        All rows of frame `name` with their run, epoch and mode columns, e.g.
+        read('metrics', mode='eval') for the test metrics of every run and epoch.
+        """
+        src = os.path.join(self.root, name)
+        if not os.path.exists(src):
+            return pd.DataFrame()
+        dataset = ds.dataset(src, format='parquet', partitioning='hive')
+        # metric columns differ between modes, so scan with the union of every file's columns
+        schema = pa.unify_schemas([fragment.physical_schema for fragment in dataset.get_fragments()] +
+                                  [dataset.partitioning.schema])
+        dataset = ds.dataset(src, schema=schema, format='parquet', partitioning='hive')
+
+        condition = None
+        for key, val in partitions.items():
+            condition = ds.field(key) == val if condition is None else condition & (ds.field(key) == val)
+        return dataset.to_table(columns=columns, filter=condition).to_pandas()
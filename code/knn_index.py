@@ -0,0 +1,218 @@
+import math
+
+import torch
+import torch.nn.functional as F
+
+import quantization
+from utils import topk_neighbours
+
+
+class FlatIndex():
+    """
+    Exact cosine search over every stored embedding (brute force, chunked over queries).
+    """
+    name = 'flat'
+
+    def __init__(self, chunk_size=4096):
+        self.chunk_size = chunk_size
+        self.X = None
+
+    def add(self, X):
+        self.X = X
+
+    def search(self, Q, k):
+        sims = torch.empty((len(Q), k), dtype=self.X.dtype)
+        idx = torch.empty((len(Q), k), dtype=torch.long)
+        for start in range(0, len(Q), self.chunk_size):
+            chunk_sims, chunk_idx = F.linear(Q[start:start + self.chunk_size], self.X).topk(k)
+            sims[start:start + len(chunk_idx)] = chunk_sims
+            idx[start:start + len(chunk_idx)] = chunk_idx
+        return sims, idx
+
+    def neighbours(self, X, k, queries=None):
+        """ k nearest other items for every row (or the `queries` rows) of the indexed X, as utils.topk_neighbours. """
+        return topk_neighbours(X, k, self.chunk_size, queries)
+
+
+class IVFFlatIndex():
+    """
+    Inverted file index: embeddings are bucketed by their closest k-means centroid and a
+    query is only compared against the members of its `nprobe` closest buckets.
+    """
+    name = 'ivf'
+
+    def __init__(self, nlist=None, nprobe=8, nb_iter=10, max_train_per_list=256, chunk_size=4096, seed=0):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.nb_iter = nb_iter
+        self.max_train_per_list = max_train_per_list
+        self.chunk_size = chunk_size
+        self.seed = seed
+        self.X = None
+
+    def _closest_centroids(self, X, nb_closest):
+        closest = torch.empty((len(X), nb_closest), dtype=torch.long)
+        for start in range(0, len(X), self.chunk_size):
+            sims = F.linear(X[start:start + self.chunk_size], self.centroids)
+            closest[start:start + len(sims)] = sims.topk(nb_closest)[1]
+        return closest
+
+    def _train(self, X):
+        generator = torch.Generator().manual_seed(self.seed)
+        sample = X[torch.randperm(len(X), generator=generator)[:self.nlist * self.max_train_per_list]]
+        self.centroids = sample[:self.nlist].clone()
+
+        # spherical k-means: assign by cosine, re-normalise the mean of every cluster
+        for _ in range(self.nb_iter):
+            assign = self._closest_centroids(sample, 1)[:, 0]
+            sums = torch.zeros_like(self.centroids).index_add_(0, assign, sample)
+            counts = torch.bincount(assign, minlength=self.nlist)
+            filled = counts > 0
+            self.centroids[filled] = F.normalize(sums[filled], dim=1)
+
+    def add(self, X):
+        self.X = X
+        if self.nlist is None:
+            self.nlist = max(1, int(round(math.sqrt(len(X)))))
+        self.nlist = min(self.nlist, len(X))
+        self._train(X)
+
+        assign = self._closest_centroids(X, 1)[:, 0]
+        self.list_members = torch.argsort(assign, stable=True)
+        self.list_offsets = torch.zeros(self.nlist + 1, dtype=torch.long)
+        self.list_offsets[1:] = torch.cumsum(torch.bincount(assign, minlength=self.nlist), 0)
+
+    def search(self, Q, k):
+        nprobe = min(self.nprobe, self.nlist)
+        probes = self._closest_centroids(Q, nprobe).flatten()
+
+        # group the queries by the list they probe, then scan each list once
+        order = torch.argsort(probes, stable=True)
+        probe_queries = order // nprobe
+        probe_offsets = torch.zeros(self.nlist + 1, dtype=torch.long)
+        probe_offsets[1:] = torch.cumsum(torch.bincount(probes, minlength=self.nlist), 0)
+
+        best_sims = torch.full((len(Q), k), -float('inf'), dtype=self.X.dtype)
+        best_idx = torch.full((len(Q), k), -1, dtype=torch.long)
+        for l in range(self.nlist):
+            queries = probe_queries[probe_offsets[l]:probe_offsets[l + 1]]
+            members = self.list_members[self.list_offsets[l]:self.list_offsets[l + 1]]
+            if len(queries) == 0 or len(members) == 0:
+                continue
+            sims = torch.cat((best_sims[queries], F.linear(Q[queries], self.X[members])), dim=1)
+            idx = torch.cat((best_idx[queries], members.expand(len(queries), -1)), dim=1)
+            top_sims, top_pos = sims.topk(k)
+            best_sims[queries] = top_sims
+            best_idx[queries] = torch.gather(idx, 1, top_pos)
+        return best_sims, best_idx
+
+    def neighbours(self, X, k, queries=None):
+        return approximate_neighbours(self, X, k, queries)
+
+
+class QuantizedIndex():
+    """
+    Keeps only compact codes of the embeddings (see quantization.py) and ranks them by
+    asymmetric cosine similarity: full precision query against decoded gallery, normalised
+    by the norm of each reconstruction. With `rerank` > 0 the best `rerank` candidates of
+    every query are re-scored exactly, which needs the full precision X (e.g. a memmap).
+    """
+    name = 'quantized'
+
+    def __init__(self, quantizer, rerank=0, chunk_size=4096):
+        self.quantizer = quantizer
+        self.rerank = rerank
+        self.chunk_size = chunk_size
+        self.X = None
+
+    def add(self, X):
+        self.quantizer.train(X)
+        self.codes = self.quantizer.encode(X)
+        self.norms = torch.cat([self.quantizer.decode(self.codes[start:start + self.chunk_size]).norm(dim=1)
+                                for start in range(0, len(self.codes), self.chunk_size)]).clamp_(min=1e-12)
+        if self.rerank:
+            self.X = X
+
+    def search(self, Q, k):
+        k = min(k, len(self.codes))
+        shortlist = min(max(k, self.rerank), len(self.codes))
+        sims = torch.empty((len(Q), k), dtype=torch.float32)
+        idx = torch.empty((len(Q), k), dtype=torch.long)
+        for start in range(0, len(Q), self.chunk_size):
+            q = Q[start:start + self.chunk_size].float()
+            chunk_sims, chunk_idx = (self.quantizer.inner_products(q, self.codes) / self.norms).topk(shortlist)
+            if self.rerank:
+                chunk_sims, chunk_idx = self._rerank(q, chunk_idx, k)
+            sims[start:start + len(q)] = chunk_sims[:, :k]
+            idx[start:start + len(q)] = chunk_idx[:, :k]
+        return sims, idx
+
+    def _rerank(self, q, shortlist_idx, k):
+        """ Exact top k of every query's shortlist, reading at most chunk_size full precision candidates at a time. """
+        step = max(1, self.chunk_size // shortlist_idx.shape[1])
+        sims = torch.empty((len(q), k), dtype=torch.float32)
+        idx = torch.empty((len(q), k), dtype=torch.long)
+        for start in range(0, len(q), step):
+            chunk_idx = shortlist_idx[start:start + step]
+            candidates = torch.as_tensor(self.X[chunk_idx.flatten().numpy()]).float().view(*chunk_idx.shape, -1)
+            sims[start:start + step], order = torch.bmm(candidates, q[start:start + step, :, None])[:, :, 0].topk(k)
+            idx[start:start + step] = torch.gather(chunk_idx, 1, order)
+        return sims, idx
+
+    def neighbours(self, X, k, queries=None):
+        return approximate_neighbours(self, X, k, queries)
+
+
+def approximate_neighbours(index, X, k, queries=None):
+    """
+    k nearest other items for every row (or the `queries` rows) of the indexed X. The query
+    itself is removed wherever it shows up; rows for which the index found fewer than k + 1
+    items fall back to an exact search.
+    """
+    queries = torch.arange(len(X)) if queries is None else torch.as_tensor(queries)
+    _, idx = index.search(X[queries], k + 1)
+    is_self = idx == queries[:, None]
+    idx = torch.gather(idx, 1, torch.argsort(is_self.int(), dim=1, stable=True))[:, :k]
+
+    incomplete = torch.nonzero((idx == -1).any(dim=1)).squeeze(dim=1)
+    if len(incomplete):
+        exact = F.linear(X[queries[incomplete]], X)
+        exact[torch.arange(len(incomplete)), queries[incomplete]] = -float('inf')
+        idx[incomplete] = exact.topk(k)[1]
+    return idx
+
+
+_type = {
+    'flat': FlatIndex,
+    'ivf': IVFFlatIndex,
+    'pq': QuantizedIndex,
+    'sq8': QuantizedIndex,
+}
+
+
+def create(name, **kwargs):
+    if name in quantization._type:
+        quantizer_kwargs = {key: kwargs.pop(key) for key in ['nb_subspaces', 'nb_centroids'] if key in kwargs}
+        return _type[name](quantization.create(name, **quantizer_kwargs), **kwargs)
+    return _type[name](**kwargs)
+
+
+def recall_vs_exact(X, neighbors, k, nb_queries=1000, chunk_size=4096, seed=0, queries=None):
+    """
+    Fraction of the exact k nearest neighbours (self excluded) that `neighbors` recovered,
+    measured on a random subset of `nb_queries` of its rows. `queries` are the positions in X
+    of the rows of `neighbors` if it wasn't searched for every row.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    rows = torch.randperm(len(neighbors), generator=generator)[:nb_queries]
+    queries = rows if queries is None else torch.as_tensor(queries)[rows]
+
+    exact = FlatIndex(chunk_size)
+    exact.add(X)
+    _, exact_idx = exact.search(X[queries], k + 1)
+    is_self = exact_idx == queries[:, None]
+    exact_idx = torch.gather(exact_idx, 1, torch.argsort(is_self.int(), dim=1, stable=True))[:, :k]
+
+    approx_idx = torch.as_tensor(neighbors)[rows, :k]
+    hits = (approx_idx[:, :, None] == exact_idx[:, None, :]).any(dim=2)
+    return hits.float().mean().item()
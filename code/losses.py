@@ -3,16 +3,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 import math
 import random
-from pytorch_metric_learning import miners, losses
-
-def binarize(T, nb_classes):
-    T = T.cpu().numpy()
-    import sklearn.preprocessing
-    T = sklearn.preprocessing.label_binarize(
-        T, classes = range(0, nb_classes)
-    )
-    T = torch.FloatTensor(T)
-    return T
+from pytorch_metric_learning import losses
 
 def l2_norm(input):
     input_size = input.size()
@@ -23,8 +14,65 @@ def l2_norm(input):
     output = _output.view(input_size)
     return output
 
+class _ProxyAnchorNegatives(torch.autograd.Function):
+    """
+    softplus(logsumexp_i alpha * (cos(X_i, P_c) + mrg)) over the samples i not of class c, for
+    every proxy c, computed `chunk_size` proxies at a time. Only the logsumexp of every proxy is kept for the
+    backward pass, which recomputes the similarities of each chunk, so no B x C tensor outlives
+    a chunk. X has to be l2 normalised already, P is normalised chunk by chunk.
+    """
+    @staticmethod
+    def forward(ctx, X, P, T, alpha, mrg, chunk_size):
+        lse = torch.empty(len(P), dtype=X.dtype, device=X.device)
+        for start in range(0, len(P), chunk_size):
+            lse[start:start + chunk_size] = torch.logsumexp(
+                _ProxyAnchorNegatives._logits(X, l2_norm(P[start:start + chunk_size]), T, start, alpha, mrg), dim=0)
+        ctx.save_for_backward(X, P, T, lse)
+        ctx.alpha, ctx.mrg, ctx.chunk_size = alpha, mrg, chunk_size
+        return F.softplus(lse)
+
+    @staticmethod
+    def _logits(X, P_chunk, T, start, alpha, mrg):
+        logits = alpha * (F.linear(X, P_chunk) + mrg)
+        in_chunk = (T >= start) & (T < start + len(P_chunk))
+        logits[in_chunk, T[in_chunk] - start] = torch.finfo(logits.dtype).min  # mask the positives
+        return logits
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        X, P, T, lse = ctx.saved_tensors
+        grad_X = torch.zeros_like(X)
+        grad_P = torch.empty_like(P)
+        # d softplus(lse_c) / d lse_c = sigmoid(lse_c), d lse_c / d logit_ic = softmax over i
+        weights = grad_output * ctx.alpha * torch.sigmoid(lse)
+        for start in range(0, len(P), ctx.chunk_size):
+            P_chunk = P[start:start + ctx.chunk_size]
+            norms = torch.sqrt(torch.sum(P_chunk ** 2, dim=1, keepdim=True) + 1e-12)
+            P_normed = P_chunk / norms
+            logits = _ProxyAnchorNegatives._logits(X, P_normed, T, start, ctx.alpha, ctx.mrg)
+            grad_cos = torch.exp(logits - lse[None, start:start + len(P_chunk)]) * weights[None, start:start + len(P_chunk)]
+
+            grad_X += grad_cos @ P_normed
+            grad_P_normed = grad_cos.T @ X
+            grad_P[start:start + len(P_chunk)] = \
+                (grad_P_normed - P_normed * (P_normed * grad_P_normed).sum(dim=1, keepdim=True)) / norms
+        return grad_X, grad_P, None, None, None, None
+
+
 class Proxy_Anchor(torch.nn.Module):
-    def __init__(self, nb_classes, sz_embed, mrg=0.1, alpha=32):
+    """
+    chunk_size : if set, the negative term is computed by _ProxyAnchorNegatives, `chunk_size`
+                 proxies at a time, so memory doesn't grow with B x nb_classes (slower, the
+                 similarities are computed twice)
+    hard_negatives : if set, only the proxies of the batch's classes and the `hard_negatives`
+                 negative proxies most similar to any sample of the batch enter the loss exactly.
+                 They are looked up in a knn_index of the proxies rebuilt every `refresh_every`
+                 training steps. The rest of the negative term is estimated from `hard_negatives`
+                 uniformly drawn other proxies, scaled up to the number of proxies left out, so
+                 the loss stays an unbiased estimate of the full one.
+    """
+    def __init__(self, nb_classes, sz_embed, mrg=0.1, alpha=32, chunk_size=None, hard_negatives=0,
+                 refresh_every=200, proxy_index='flat'):
         torch.nn.Module.__init__(self)
         self.proxies = torch.nn.Parameter(torch.randn(nb_classes, sz_embed))
         nn.init.kaiming_normal_(self.proxies, mode='fan_out')
@@ -33,26 +81,80 @@ class Proxy_Anchor(torch.nn.Module):
         self.sz_embed = sz_embed
         self.mrg = mrg
         self.alpha = alpha
-        
+        self.chunk_size = chunk_size
+        self.hard_negatives = hard_negatives
+        self.refresh_every = refresh_every
+        self.proxy_index = proxy_index
+        self.index = None
+        self.step = 0
+
+    @torch.no_grad()
+    def _hard_proxies(self, X, T):
+        """
+        Sorted ids of the batch's own proxies and of its hardest negative proxies, and ids drawn
+        (with replacement) from the remaining proxies.
+        """
+        import knn_index
+        if self.index is None or self.step % self.refresh_every == 0:
+            self.index = knn_index.create(self.proxy_index)
+            self.index.add(l2_norm(self.proxies.detach()))
+        if self.training:
+            self.step += 1
+
+        sims, ids = self.index.search(X.detach(), min(self.hard_negatives, self.nb_classes))
+        found = (ids >= 0) & (ids != T[:, None])
+        scores = torch.full((self.nb_classes,), -float('inf'), dtype=sims.dtype, device=sims.device)
+        scores = scores.scatter_reduce(0, ids[found], sims[found], reduce='amax')
+        hardest = scores.topk(min(self.hard_negatives, self.nb_classes))
+        selected = torch.unique(torch.cat((T, hardest[1][hardest[0] > -float('inf')])))
+
+        sampled = torch.randint(self.nb_classes, (self.hard_negatives,), device=selected.device)
+        sampled = sampled[~torch.isin(sampled, selected)]
+        return selected, sampled
+
     def forward(self, X, T):
         P = self.proxies
+        T = T.reshape(-1).to(X.device).long()
+        X = l2_norm(X)
 
-        cos = F.linear(l2_norm(X), l2_norm(P))  # Calcluate cosine similarity
-        P_one_hot = binarize(T = T, nb_classes = self.nb_classes)
-        N_one_hot = 1 - P_one_hot
-    
-        pos_exp = torch.exp(-self.alpha * (cos - self.mrg))
-        neg_exp = torch.exp(self.alpha * (cos + self.mrg))
+        weights = None
+        if self.hard_negatives:
+            selected, sampled = self._hard_proxies(X, T)
+            P = P[torch.cat((selected, sampled))]
+            T = torch.searchsorted(selected, T)
+            weights = torch.ones(len(P), dtype=X.dtype, device=X.device)
+            if len(sampled):
+                weights[len(selected):] = (self.nb_classes - len(selected)) / len(sampled)
 
-        with_pos_proxies = torch.nonzero(P_one_hot.sum(dim = 0) != 0).squeeze(dim = 1)   # The set of positive proxies of data in the batch
+        if self.chunk_size:
+            pos_cos = (X * l2_norm(P[T])).sum(dim=1)
+        else:
+            cos = F.linear(X, l2_norm(P))  # Calcluate cosine similarity
+            pos_cos = cos.gather(1, T[:, None]).squeeze(dim=1)
+
+        # positive term: log(1 + sum_i exp(-alpha * (cos_ic - mrg))) over the samples i of class c,
+        # scattered per label from the B positive similarities only
+        pos_logits = -self.alpha * (pos_cos - self.mrg)
+        shift = torch.zeros(len(P), dtype=X.dtype, device=X.device)
+        shift = shift.scatter_reduce(0, T, pos_logits.detach(), reduce='amax')  # >= 0, keeps exp from overflowing
+        pos_sums = torch.exp(-shift).index_add(0, T, torch.exp(pos_logits - shift[T]))
+
+        with_pos_proxies = torch.unique(T)   # The set of positive proxies of data in the batch
         num_valid_proxies = len(with_pos_proxies)   # The number of positive proxies
-        
-        P_sim_sum = torch.where(P_one_hot == 1, pos_exp, torch.zeros_like(pos_exp)).sum(dim=0) 
-        N_sim_sum = torch.where(N_one_hot == 1, neg_exp, torch.zeros_like(neg_exp)).sum(dim=0)
-        
-        pos_term = torch.log(1 + P_sim_sum).sum() / num_valid_proxies
-        neg_term = torch.log(1 + N_sim_sum).sum() / self.nb_classes
-        loss = pos_term + neg_term     
+        pos_term = (shift + torch.log(pos_sums))[with_pos_proxies].sum() / num_valid_proxies
+
+        # negative term: log(1 + sum_i exp(alpha * (cos_ic + mrg))) over the samples i not of class c,
+        # a logsumexp with the positives masked out
+        if self.chunk_size:
+            neg_per_proxy = _ProxyAnchorNegatives.apply(X, P, T, self.alpha, self.mrg, self.chunk_size)
+        else:
+            neg_logits = (self.alpha * (cos + self.mrg)).scatter(1, T[:, None], torch.finfo(cos.dtype).min)
+            neg_per_proxy = F.softplus(torch.logsumexp(neg_logits, dim=0))
+        if weights is not None:
+            neg_per_proxy = neg_per_proxy * weights
+        neg_term = neg_per_proxy.sum() / self.nb_classes
+
+        loss = pos_term + neg_term
         return loss
 
 # We use PyTorch Metric Learning library for the following codes.
@@ -69,7 +171,56 @@ class Proxy_NCA(torch.nn.Module):
         loss = self.loss_func(embeddings, labels)
         return loss
     
+def pair_masks(labels):
+    """ [B x B] masks of the positive pairs (same label, without the diagonal) and of the negative pairs. """
+    same = labels[:, None] == labels[None, :]
+    return same & ~torch.eye(len(labels), dtype=torch.bool, device=labels.device), ~same
+
+
+class MultiSimilarityMiner(nn.Module):
+    """
+    MultiSimilarityMiner of pytorch-metric-learning on a precomputed cosine similarity matrix:
+    keeps the positive pairs less similar than the anchor's most similar negative + epsilon and
+    the negative pairs more similar than its least similar positive - epsilon.
+    Returns the [B x B] masks of the mined positive and negative pairs.
+    """
+    def __init__(self, epsilon=0.1):
+        super(MultiSimilarityMiner, self).__init__()
+        self.epsilon = epsilon
+
+    @torch.no_grad()
+    def forward(self, sim, labels):
+        pos_mask, neg_mask = pair_masks(labels)
+        hardest_neg = sim.masked_fill(~neg_mask, -float('inf')).amax(dim=1, keepdim=True)
+        easiest_pos = sim.masked_fill(~pos_mask, float('inf')).amin(dim=1, keepdim=True)
+        return pos_mask & (sim - self.epsilon < hardest_neg), neg_mask & (sim + self.epsilon > easiest_pos)
+
+
+class SemihardTripletMiner(nn.Module):
+    """
+    TripletMarginMiner(type_of_triplets='semihard') of pytorch-metric-learning on a precomputed
+    distance matrix: the triplets with 0 < d(a, n) - d(a, p) <= margin. Negatives are searched per
+    positive pair, P x B instead of the B x B x B of every triplet.
+    Returns the anchor, positive and negative ids.
+    """
+    def __init__(self, margin=0.1):
+        super(SemihardTripletMiner, self).__init__()
+        self.margin = margin
+
+    @torch.no_grad()
+    def forward(self, dist, labels):
+        pos_mask, neg_mask = pair_masks(labels)
+        a, p = torch.nonzero(pos_mask, as_tuple=True)
+        triplet_margin = dist[a] - dist[a, p][:, None]
+        pair, n = torch.nonzero(neg_mask[a] & (triplet_margin > 0) & (triplet_margin <= self.margin), as_tuple=True)
+        return a[pair], p[pair], n
+
+
 class MultiSimilarityLoss(torch.nn.Module):
+    """
+    MultiSimilarityLoss and MultiSimilarityMiner of pytorch-metric-learning, with the similarity
+    matrix computed once per step for both mining and loss.
+    """
     def __init__(self, ):
         super(MultiSimilarityLoss, self).__init__()
         self.thresh = 0.5
@@ -77,12 +228,22 @@ class MultiSimilarityLoss(torch.nn.Module):
         self.scale_pos = 2
         self.scale_neg = 50
         
-        self.miner = miners.MultiSimilarityMiner(epsilon=self.epsilon)
-        self.loss_func = losses.MultiSimilarityLoss(self.scale_pos, self.scale_neg, self.thresh)
+        self.miner = MultiSimilarityMiner(epsilon=self.epsilon)
         
     def forward(self, embeddings, labels):
-        hard_pairs = self.miner(embeddings, labels)
-        loss = self.loss_func(embeddings, labels, hard_pairs)
+        labels = labels.reshape(-1).to(embeddings.device)
+        X = l2_norm(embeddings)
+        sim = F.linear(X, X)
+        pos_mask, neg_mask = self.miner(sim.detach(), labels)
+        if pos_mask.sum() <= 1 and neg_mask.sum() <= 1:
+            return torch.sum(embeddings * 0)
+
+        # log(1 + sum exp(.)) over the mined pairs of every anchor, 0 for anchors without any
+        pos_logits = (-self.scale_pos * (sim - self.thresh)).masked_fill(~pos_mask, -float('inf'))
+        neg_logits = (self.scale_neg * (sim - self.thresh)).masked_fill(~neg_mask, -float('inf'))
+        pos_loss = F.softplus(torch.logsumexp(pos_logits, dim=1)) / self.scale_pos
+        neg_loss = F.softplus(torch.logsumexp(neg_logits, dim=1)) / self.scale_neg
+        loss = (pos_loss + neg_loss).mean()
         return loss
     
 class ContrastiveLoss(nn.Module):
@@ -96,15 +257,27 @@ class ContrastiveLoss(nn.Module):
         return loss
     
 class TripletLoss(nn.Module):
+    """
+    Semihard mined TripletMarginLoss of pytorch-metric-learning on l2 normalised embeddings, with the
+    distance matrix computed once per step for both mining and loss.
+    """
     def __init__(self, margin=0.1, **kwargs):
         super(TripletLoss, self).__init__()
         self.margin = margin
-        self.miner = miners.TripletMarginMiner(margin, type_of_triplets = 'semihard')
-        self.loss_func = losses.TripletMarginLoss(margin = self.margin)
+        self.miner = SemihardTripletMiner(margin)
         
     def forward(self, embeddings, labels):
-        hard_pairs = self.miner(embeddings, labels)
-        loss = self.loss_func(embeddings, labels, hard_pairs)
+        labels = labels.reshape(-1).to(embeddings.device)
+        X = l2_norm(embeddings)
+        dist = torch.cdist(X, X)
+        a, p, n = self.miner(dist.detach(), labels)
+
+        # average of the triplets violating the margin
+        violation = F.relu(dist[a, p] - dist[a, n] + self.margin)
+        violation = violation[violation > 0]
+        if len(violation) == 0:
+            return torch.sum(embeddings * 0)
+        loss = violation.mean()
         return loss
     
 class NPairLoss(nn.Module):
@@ -0,0 +1,192 @@
+"""
+Deferred rendering of evaluation plots.
+
+Evaluation only saves the compact inputs of a plot (`<plot>.npz` next to where `<plot>.png`
+belongs): the edge list of a centroid graph or the counts of a confusion matrix. Rendering
+happens right away, in a pool of processes or on demand with
+
+    python plots.py ../training/<dataset>/<run>/
+
+and is skipped when a png was already rendered from identical inputs.
+"""
+import os
+import sys
+import shutil
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing as mp
+
+import numpy as np
+
+# bump when the drawing code changes so cached pngs are redrawn
+RENDER_VERSION = 1
+
+
+def save_plot_inputs(png_path, kind, **arrays):
+    inputs_path = os.path.splitext(png_path)[0] + '.npz'
+    np.savez(inputs_path, kind=np.array(kind), **arrays)
+    return inputs_path
+
+
+def inputs_hash(inputs):
+    h = hashlib.sha1(str(RENDER_VERSION).encode())
+    for key in sorted(inputs.files):
+        arr = inputs[key]
+        h.update(key.encode())
+        h.update(str(arr.dtype).encode())
+        h.update(str(arr.shape).encode())
+        h.update(np.ascontiguousarray(arr).tobytes())
+    return h.hexdigest()
+
+
+def _draw_node_graph(inputs, png_path):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import networkx as nx
+
+    labels = inputs['labels']
+    edges = inputs['edges']
+
+    G = nx.Graph()
+    G.add_nodes_from(labels)
+    G.add_weighted_edges_from((labels[int(i)], labels[int(j)], w) for i, j, w in edges)
+
+    pos = nx.spring_layout(G)
+
+    fig = plt.Figure(figsize=(120, 60))
+    ax = fig.add_subplot(111)
+    nx.draw_networkx_labels(G, pos=pos, bbox=dict(
+        boxstyle='round', ec=(0.0, 0.0, 0.0),
+        alpha=0.9, fc='white', lw=1.5
+    ),
+                            verticalalignment='center', ax=ax)
+    nx.draw(G, node_size=600, pos=pos, with_labels=False, ax=ax)
+    fig.savefig(png_path, bbox_inches='tight', dpi=200)
+
+
+def _draw_confusion(inputs, png_path):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    param = str(inputs['param'])
+    labels = inputs['labels']
+
+    fig = plt.figure(figsize=(48, 48))
+    ax = fig.add_subplot(111)
+    annot = param != 'label_fine'
+    sns.heatmap(inputs['counts'], annot=annot, fmt='g', ax=ax,
+                annot_kws={"size": 4})  # annot=True to annotate cells, ftm='g' to disable scientific notation
+
+    # labels, title and ticks
+    ax.set_xlabel('Predicted labels')
+    ax.set_ylabel('True labels')
+    ax.set_title(f'Confusion Matrix for {param}')
+    ax.xaxis.set_ticklabels(labels)
+    ax.yaxis.set_ticklabels(labels)
+    fig.savefig(png_path, bbox_inches='tight', dpi=300)
+    plt.close(fig)
+
+
+_draw = {
+    'node_graph': _draw_node_graph,
+    'confusion': _draw_confusion,
+}
+
+
+def render(inputs_path, cache_dir=None):
+    """
+    Renders the png belonging to `inputs_path` unless it was already rendered from the same inputs,
+    either at the same place (`<plot>.sha1` sidecar) or anywhere else (`cache_dir/<hash>.png`).
+    """
+    png_path = os.path.splitext(inputs_path)[0] + '.png'
+    sidecar_path = os.path.splitext(inputs_path)[0] + '.sha1'
+    with np.load(inputs_path) as inputs:
+        digest = inputs_hash(inputs)
+
+        if os.path.exists(png_path) and os.path.exists(sidecar_path):
+            with open(sidecar_path) as f:
+                if f.read() == digest:
+                    return png_path
+
+        cached_png = os.path.join(cache_dir, digest + '.png') if cache_dir else None
+        if cached_png and os.path.exists(cached_png):
+            shutil.copyfile(cached_png, png_path)
+        else:
+            _draw[str(inputs['kind'])](inputs, png_path)
+            if cached_png:
+                os.makedirs(cache_dir, exist_ok=True)
+                shutil.copyfile(png_path, cached_png)
+
+    with open(sidecar_path, 'w') as f:
+        f.write(digest)
+    return png_path
+
+
+class PlotRenderer():
+    """
+    mode 'sync' renders when a plot is submitted, 'pool' renders in `processes` background
+    processes, 'lazy' only keeps the inputs (render them later with `python plots.py <dir>`).
+    """
+    modes = ['sync', 'pool', 'lazy']
+
+    def __init__(self, mode='sync', processes=None, cache_dir=None):
+        assert mode in self.modes, f'mode has to be one of {self.modes}'
+        self.mode = mode
+        self.cache_dir = cache_dir
+        self.futures = []
+        self.pool = None
+        if mode == 'pool':
+            self.pool = ProcessPoolExecutor(processes, mp_context=mp.get_context('spawn'))
+
+    def submit(self, inputs_path):
+        if self.mode == 'sync':
+            render(inputs_path, self.cache_dir)
+        elif self.mode == 'pool':
+            self.futures.append((inputs_path, self.pool.submit(render, inputs_path, self.cache_dir)))
+            self._collect(wait=False)
+
+    def _collect(self, wait):
+        pending = []
+        for inputs_path, future in self.futures:
+            if not wait and not future.done():
+                pending.append((inputs_path, future))
+            elif future.exception() is not None:
+                print(f'WARNING: Cant render {inputs_path}: {future.exception()}')
+        self.futures = pending
+
+    def close(self):
+        if self.pool is not None:
+            self._collect(wait=True)
+            self.pool.shutdown()
+
+
+_renderer = None
+
+
+def get_renderer(mode='sync', processes=None, cache_dir=None):
+    """ One renderer (and pool) per process, replaced if the mode changes. """
+    global _renderer
+    if _renderer is None or _renderer.mode != mode:
+        if _renderer is not None:
+            _renderer.close()
+        _renderer = PlotRenderer(mode, processes, cache_dir)
+    return _renderer
+
+
+def close_renderer():
+    global _renderer
+    if _renderer is not None:
+        _renderer.close()
+        _renderer = None
+
+
+if __name__ == '__main__':
+    # render every saved plot input below the given folders
+    for folder in sys.argv[1:]:
+        for root, dirs, files in os.walk(folder):
+            for file in sorted(files):
+                if file.endswith('.npz'):
+                    print(render(os.path.join(root, file)))
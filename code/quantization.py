@@ -0,0 +1,132 @@
+import torch
+import torch.nn.functional as F
+
+
+def _kmeans(X, nb_centroids, nb_iter, generator):
+    """
+    Plain (euclidean) k-means run independently on each of the B sets of rows of X : [B x n x d].
+    Returns [B x nb_centroids x d] centroids.
+    """
+    B, n, d = X.shape
+    centroids = X[:, torch.randperm(n, generator=generator)[:nb_centroids]].clone()
+    offsets = torch.arange(B)[:, None] * nb_centroids
+    for _ in range(nb_iter):
+        assign = (_closest(X, centroids) + offsets).flatten()
+        sums = torch.zeros(B * nb_centroids, d).index_add_(0, assign, X.reshape(-1, d))
+        counts = torch.bincount(assign, minlength=B * nb_centroids)
+        filled = counts > 0
+        centroids = centroids.reshape(-1, d)
+        centroids[filled] = sums[filled] / counts[filled, None]
+        centroids = centroids.reshape(B, nb_centroids, d)
+    return centroids
+
+
+def _closest(X, centroids, chunk_size=65536):
+    """ X : [B x n x d], centroids : [B x K x d]. Index of the closest centroid (euclidean) for every row. """
+    closest = torch.empty(X.shape[:2], dtype=torch.long)
+    sq_norms = (centroids * centroids).sum(dim=2)
+    for start in range(0, X.shape[1], chunk_size):
+        sims = torch.baddbmm(-sq_norms[:, None, :], X[:, start:start + chunk_size], centroids.transpose(1, 2),
+                             alpha=2)
+        closest[:, start:start + chunk_size] = sims.argmax(dim=2)
+    return closest
+
+
+class ProductQuantizer():
+    """
+    Splits the embedding into `nb_subspaces` equal slices and replaces every slice by the index
+    of its closest of `nb_centroids` (<= 256) k-means centroids, i.e. one byte per subspace.
+    Inner products with a full precision query are asymmetric: the query is never quantised,
+    only the gallery is (see inner_products).
+    """
+    def __init__(self, nb_subspaces=64, nb_centroids=256, nb_iter=20, max_train=65536, seed=0):
+        assert nb_centroids <= 256, 'codes are stored as uint8'
+        self.nb_subspaces = nb_subspaces
+        self.nb_centroids = nb_centroids
+        self.nb_iter = nb_iter
+        self.max_train = max_train
+        self.seed = seed
+
+    @property
+    def code_size(self):
+        return self.nb_subspaces
+
+    def _split(self, X):
+        return X.reshape(len(X), self.nb_subspaces, -1)
+
+    def train(self, X):
+        assert X.shape[1] % self.nb_subspaces == 0, 'embedding size has to be divisible by nb_subspaces'
+        generator = torch.Generator().manual_seed(self.seed)
+        sample = self._split(X[torch.randperm(len(X), generator=generator)[:self.max_train]].float())
+        nb_centroids = min(self.nb_centroids, len(sample))
+        self.codebooks = _kmeans(sample.transpose(0, 1).contiguous(), nb_centroids, self.nb_iter, generator)
+
+    def encode(self, X):
+        X = self._split(X.float()).transpose(0, 1).contiguous()
+        return _closest(X, self.codebooks).to(torch.uint8).T.contiguous()
+
+    def decode(self, codes):
+        codes = codes.long()
+        return torch.cat([self.codebooks[m][codes[:, m]] for m in range(self.nb_subspaces)], dim=1)
+
+    def inner_products(self, Q, codes, max_table_queries=64, chunk_size=65536):
+        """
+        [nb_queries x nb_codes] inner products of Q with the decoded codes. Small query batches
+        sum per-subspace lookup tables of <query slice, centroid>; large batches decode the codes
+        a chunk at a time and use one matmul per chunk instead, which gives the same values.
+        """
+        Q = Q.float()
+        if len(Q) <= max_table_queries:
+            tables = torch.einsum('qmd,mkd->qmk', self._split(Q), self.codebooks)
+            scores = torch.zeros((len(Q), len(codes)), dtype=torch.float32)
+            for m in range(self.nb_subspaces):
+                scores += tables[:, m, codes[:, m].long()]
+            return scores
+
+        scores = torch.empty((len(Q), len(codes)), dtype=torch.float32)
+        for start in range(0, len(codes), chunk_size):
+            scores[:, start:start + chunk_size] = F.linear(Q, self.decode(codes[start:start + chunk_size]))
+        return scores
+
+
+class ScalarQuantizer():
+    """
+    Stores every dimension as a uint8 between its minimum and maximum over the training set.
+    """
+    def __init__(self):
+        self.lo = None
+        self.scale = None
+
+    @property
+    def code_size(self):
+        return len(self.lo)
+
+    def train(self, X):
+        X = X.float()
+        self.lo = X.min(dim=0).values
+        self.scale = ((X.max(dim=0).values - self.lo) / 255).clamp(min=1e-12)
+
+    def encode(self, X):
+        return ((X.float() - self.lo) / self.scale).round_().clamp_(0, 255).to(torch.uint8)
+
+    def decode(self, codes):
+        return codes.float() * self.scale + self.lo
+
+    def inner_products(self, Q, codes, chunk_size=65536):
+        Q = Q.float()
+        offsets = F.linear(Q, self.lo[None, :])
+        scaled_Q = Q * self.scale
+        scores = torch.empty((len(Q), len(codes)), dtype=torch.float32)
+        for start in range(0, len(codes), chunk_size):
+            scores[:, start:start + chunk_size] = F.linear(scaled_Q, codes[start:start + chunk_size].float())
+        return scores + offsets
+
+
+_type = {
+    'pq': ProductQuantizer,
+    'sq8': ScalarQuantizer,
+}
+
+
+def create(name, **kwargs):
+    return _type[name](**kwargs)
@@ -0,0 +1,63 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+_metrics = ['cosine', 'dot', 'euclidean']
+
+
+def _as_tensor(A):
+    if isinstance(A, np.ndarray):
+        A = torch.from_numpy(A if A.flags.writeable else A.copy())
+    return A.float()
+
+
+def l2_normalize(A, eps=1e-12):
+    """ Row-wise l2 normalisation of a [n x d] torch tensor or numpy array, returned as float32 tensor. """
+    return F.normalize(_as_tensor(A), p=2, dim=-1, eps=eps)
+
+
+def pairwise_similarity(A, B=None, metric='cosine', compute_dtype=None):
+    """
+    A : [n x d], B : [m x d] (torch tensors or numpy arrays, B defaults to A)
+    metric : 'cosine', 'dot' or 'euclidean' (euclidean returns distances, not similarities)
+    compute_dtype : e.g. torch.float16 / torch.bfloat16 to run the matmul in reduced precision.
+                    The products come out in compute_dtype, rounded to its precision, and are only
+                    then upcast to float32. float16 matmuls are slow or unsupported on many CPUs, and
+                    with 'euclidean' the rounded 2 * prod cancels against the float32 squared norms,
+                    so distances of near-duplicates lose most of their precision.
+    Returns an [n x m] float32 tensor.
+    """
+    assert metric in _metrics, f'metric has to be one of {_metrics}'
+    A = _as_tensor(A)
+    B = A if B is None else _as_tensor(B)
+
+    if metric == 'cosine':
+        A, B = l2_normalize(A), l2_normalize(B)
+
+    if compute_dtype is None:
+        prod = F.linear(A, B)
+    else:
+        prod = F.linear(A.to(compute_dtype), B.to(compute_dtype)).float()
+
+    if metric == 'euclidean':
+        sq_norms_A = (A * A).sum(dim=1)
+        sq_norms_B = (B * B).sum(dim=1)
+        return (sq_norms_A[:, None] + sq_norms_B[None, :] - 2 * prod).clamp_(min=0).sqrt_()
+    return prod
+
+
+def paired_similarity(A, B, metric='cosine'):
+    """
+    A : [n x d], B : [n x k x d]
+    Returns [n x k] similarity of every row of A with its own k rows of B.
+    """
+    assert metric in _metrics, f'metric has to be one of {_metrics}'
+    A = _as_tensor(A)
+    B = _as_tensor(B)
+
+    if metric == 'cosine':
+        A, B = l2_normalize(A), l2_normalize(B)
+    if metric == 'euclidean':
+        return (B - A[:, None, :]).norm(dim=2)
+    return torch.bmm(B, A[:, :, None])[:, :, 0]
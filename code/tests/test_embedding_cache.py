@@ -0,0 +1,34 @@
+import os
+import subprocess
+import sys
+
+code_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# evaluation transforms of both architectures, with this repo's Identity, RGBToBGR and ScaleIntensities
+print_keys = '''
+import sys, types, torch
+import dataset.utils
+from embedding_cache import EmbeddingCache
+torch.manual_seed(0)
+model = torch.nn.Linear(4, 2)
+cache = EmbeddingCache(sys.argv[1])
+for is_inception in [False, True]:
+    for crop in [False, True]:
+        ds = types.SimpleNamespace(im_paths=[sys.argv[2]], transform=dataset.utils.make_transform(
+            is_train=False, is_inception=is_inception, crop=crop))
+        print(cache.keys(model, ds)[0])
+'''
+
+
+def keys_in_new_process(tmp_path, image):
+    return subprocess.run([sys.executable, '-c', print_keys, str(tmp_path / 'cache.sqlite'), str(image)],
+                          cwd=code_dir, capture_output=True, text=True, check=True).stdout.split()
+
+
+def test_keys_are_stable_across_processes(tmp_path):
+    image = tmp_path / 'image.jpg'
+    image.write_bytes(b'not really a jpg')
+    first = keys_in_new_process(tmp_path, image)
+    second = keys_in_new_process(tmp_path, image)
+    assert len(first) == 4 and len(set(first)) == 4
+    assert first == second
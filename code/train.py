@@ -1,11 +1,15 @@
 import argparse, os
-import random, dataset, utils, losses
+import random, dataset, utils, losses, knn_index, plots
 import sys
 from collections import Counter
 
 import pandas as pd
 
 from dataset.Inshop import Inshop_Dataset
+from embedding_store import EmbeddingStore
+from frame_store import FrameStore
+from embedding_cache import EmbeddingCache, is_deterministic
+from eval_worker import EvaluationWorker
 
 from net.resnet import *
 from net.googlenet import *
@@ -77,6 +81,28 @@ def parse_arguments():
     parser.add_argument('--mrg', default=0.1, type=float,
                         help='Margin parameter setting'
                         )
+    parser.add_argument('--proxy-chunk-size', default=0, type=int,
+                        dest='proxy_chunk_size',
+                        help='Compute the Proxy_Anchor negatives this many proxies at a time, recomputing them in the '
+                             'backward pass, so memory does not grow with the number of classes; 0 for the dense loss'
+                        )
+    parser.add_argument('--proxy-init', default=0, type=int,
+                        dest='proxy_init',
+                        help='Initialise the proxies with the mean embedding of their class (one pass over the training set)'
+                        )
+    parser.add_argument('--hard-proxies', default=0, type=int,
+                        dest='hard_proxies',
+                        help='Proxy_Anchor only computes the batch proxies, this many hardest negative proxies and '
+                             'as many random ones (to estimate the rest) per step; 0 uses every proxy'
+                        )
+    parser.add_argument('--proxy-refresh', default=200, type=int,
+                        dest='proxy_refresh',
+                        help='Rebuild the index the hard negative proxies are searched in every n steps'
+                        )
+    parser.add_argument('--proxy-index', default='flat', choices=['flat', 'ivf'],
+                        dest='proxy_index',
+                        help='Index the hard negative proxies are searched in'
+                        )
     parser.add_argument('--IPC', type=int,
                         help='Balanced sampling, images per class'
                         )
@@ -92,7 +118,96 @@ def parse_arguments():
     parser.add_argument('--remark', default='',
                         help='Any reamrk'
                         )
-    return parser.parse_args()
+    parser.add_argument('--eval-chunk-size', default=4096, type=int,
+                        dest='eval_chunk_size',
+                        help='Number of query rows per block of the kNN search during evaluation'
+                        )
+    parser.add_argument('--embedding-cache', default=None,
+                        dest='embedding_cache',
+                        help='sqlite file caching evaluation embeddings per image and model weights, disabled if not set. '
+                             'Only used for datasets without random augmentation (the test set); it pays off across '
+                             'runs and scripts evaluating the same weights, not between epochs'
+                        )
+    parser.add_argument('--embedding-cache-size', default=1000000, type=int,
+                        dest='embedding_cache_size',
+                        help='Maximum number of cached embeddings, least recently used ones are evicted'
+                        )
+    parser.add_argument('--index', default='flat', choices=['flat', 'ivf', 'pq', 'sq8'],
+                        help='Nearest neighbour index used for evaluation, e.g. flat (exact), ivf, pq, sq8'
+                        )
+    parser.add_argument('--ivf-nlist', default=None, type=int,
+                        dest='ivf_nlist',
+                        help='Number of k-means lists of the ivf index, sqrt(nb_samples) if not set'
+                        )
+    parser.add_argument('--ivf-nprobe', default=8, type=int,
+                        dest='ivf_nprobe',
+                        help='Number of lists the ivf index scans per query'
+                        )
+    parser.add_argument('--pq-subspaces', default=64, type=int,
+                        dest='pq_subspaces',
+                        help='Number of subspaces (bytes per embedding) of the pq index'
+                        )
+    parser.add_argument('--rerank', default=0, type=int,
+                        help='Shortlist size re-scored with full precision embeddings by the pq/sq8 index, 0 to disable'
+                        )
+    parser.add_argument('--index-recall', default=1000, type=int,
+                        dest='index_recall',
+                        help='Number of queries used to report recall of an approximate index against exact search, 0 to disable'
+                        )
+    parser.add_argument('--eval-every', default=5, type=int,
+                        dest='eval_every',
+                        help='Evaluate every n epochs'
+                        )
+    parser.add_argument('--eval-sample', default=0, type=int,
+                        dest='eval_sample',
+                        help='Predict only this many (fixed, randomly chosen) items per class during evaluation, 0 to predict all'
+                        )
+    parser.add_argument('--full-eval-every', default=0, type=int,
+                        dest='full_eval_every',
+                        help='With --eval-sample, predict every item every n epochs anyway (always in the last epoch)'
+                        )
+    parser.add_argument('--bootstrap', default=0, type=int,
+                        help='Number of bootstrap resamples for confidence intervals of the evaluation metrics, 0 to disable'
+                        )
+    parser.add_argument('--class-eval', default=0, type=int,
+                        dest='class_eval',
+                        help='Also predict every evaluated item as its nearest proxy (validation of proxy losses) '
+                             'or class centroid, and report its accuracy and agreement with kNN'
+                        )
+    parser.add_argument('--eval-k', default=[1, 3, 5, 7], type=int, nargs='+',
+                        dest='eval_ks',
+                        help='Neighbourhood sizes k to report recall@k and f1score@k for (up to 32), the best '
+                             'checkpoint is the one with the best eval_f1score@k of the largest k'
+                        )
+    parser.add_argument('--async-eval', default=0, type=int,
+                        dest='async_eval',
+                        help='Evaluate in a background process instead of pausing training'
+                        )
+    parser.add_argument('--async-eval-queue', default=1, type=int,
+                        dest='async_eval_queue',
+                        help='Number of model snapshots that may wait for the background evaluation'
+                        )
+    parser.add_argument('--plots', default='sync', choices=plots.PlotRenderer.modes,
+                        help='Render evaluation plots right away (sync), in background processes (pool) '
+                             'or only save their inputs for `python plots.py <dir>` (lazy)'
+                        )
+    parser.add_argument('--plot-processes', default=2, type=int,
+                        dest='plot_processes',
+                        help='Number of processes rendering plots with --plots pool'
+                        )
+    parser.add_argument('--eval-format', default='csv', choices=['csv', 'parquet'],
+                        dest='eval_format',
+                        help='Save evaluation metrics and predictions as csv files per epoch or append them to '
+                             'one Parquet store per dataset (../training/<dataset>/frames/, needs pyarrow)'
+                        )
+    parser.add_argument('--embedding-store', default=None,
+                        dest='embedding_store',
+                        help='Folder to persist evaluation embeddings in (memory-mapped), disabled if not set'
+                        )
+    args = parser.parse_args()
+    if not all(1 <= k <= 32 for k in args.eval_ks):
+        parser.error('--eval-k values have to be between 1 and 32, the number of neighbours searched')
+    return args
 
 
 def get_transform(train, crop=True):
@@ -216,6 +331,37 @@ def create_generators():
     return dl_tr, dl_val, dl_ev
 
 
+def create_inshop_generators():
+    trn_dataset = Inshop_Dataset(
+        root=data_root,
+        mode='train',
+        transform=get_transform(True))
+
+    dl_tr = torch.utils.data.DataLoader(
+        trn_dataset,
+        batch_size=args.sz_batch,
+        shuffle=True,
+        num_workers=args.nb_workers,
+        drop_last=True,
+        pin_memory=True
+    )
+
+    dl_query, dl_gallery = [
+        torch.utils.data.DataLoader(
+            Inshop_Dataset(
+                root=data_root,
+                mode=mode,
+                transform=get_transform(False, crop=False)),
+            batch_size=args.sz_batch,
+            shuffle=False,
+            num_workers=args.nb_workers,
+            pin_memory=True
+        )
+        for mode in ['query', 'gallery']
+    ]
+    return dl_tr, dl_query, dl_gallery
+
+
 def create_model():
     # Backbone Model
     if args.model.find('googlenet') + 1:
@@ -243,7 +389,9 @@ def create_loss(nb_classes):
     # DML Losses
     if args.loss == 'Proxy_Anchor':
         criterion = losses.Proxy_Anchor(nb_classes=nb_classes, sz_embed=args.sz_embedding, mrg=args.mrg,
-                                        alpha=args.alpha)
+                                        alpha=args.alpha, chunk_size=args.proxy_chunk_size or None,
+                                        hard_negatives=args.hard_proxies, refresh_every=args.proxy_refresh,
+                                        proxy_index=args.proxy_index)
     elif args.loss == 'Proxy_NCA':
         criterion = losses.Proxy_NCA(nb_classes=nb_classes, sz_embed=args.sz_embedding)
     elif args.loss == 'MS':
@@ -257,6 +405,43 @@ def create_loss(nb_classes):
     return criterion
 
 
+def class_proxies(criterion):
+    # one learned vector per class for the proxy based losses, None for the others
+    if isinstance(criterion, losses.Proxy_Anchor):
+        return criterion.proxies
+    if isinstance(criterion, losses.Proxy_NCA):
+        return criterion.loss_func.proxies
+    return None
+
+
+def init_proxies(criterion, dl_tr):
+    # seed every proxy that has training items with the mean embedding of its class
+    proxies = class_proxies(criterion)
+    if proxies is None:
+        print(f'WARNING: {args.loss} has no proxies to initialise')
+        return
+    means, counts = utils.proxy_init_calc(model, dl_tr)
+    seen = torch.nonzero(counts).squeeze(1)
+    with torch.no_grad():
+        proxies[seen] = means[seen].to(proxies.device, proxies.dtype)
+    print(f'Initialised {len(seen)}/{len(proxies)} proxies with their class mean')
+
+
+def create_index():
+    # Nearest neighbour search used by evaluation
+    if args.index == 'flat':
+        index = knn_index.create('flat', chunk_size=args.eval_chunk_size)
+    elif args.index == 'ivf':
+        index = knn_index.create('ivf', nlist=args.ivf_nlist, nprobe=args.ivf_nprobe,
+                                 chunk_size=args.eval_chunk_size)
+    elif args.index == 'pq':
+        index = knn_index.create('pq', nb_subspaces=args.pq_subspaces, rerank=args.rerank,
+                                 chunk_size=args.eval_chunk_size)
+    elif args.index == 'sq8':
+        index = knn_index.create('sq8', rerank=args.rerank, chunk_size=args.eval_chunk_size)
+    return index
+
+
 def create_optimizer_and_prepare_layers():
     # Train Parameters
     param_groups = [
@@ -306,9 +491,11 @@ def perform_warmup(epoch):
             param.requires_grad = True
 
 
-def torch_save(save_dir):
+def torch_save(save_dir, state_dict=None):
     os.makedirs(save_dir, exist_ok=True)
-    torch.save({'model_state_dict': model.state_dict()},
+    if state_dict is None:
+        state_dict = model.state_dict()
+    torch.save({'model_state_dict': state_dict},
                '{}/{}_{}_best.pth'.format(save_dir, args.dataset, args.model))
 
 
@@ -319,9 +506,11 @@ def text_save(recalls, best_epoch):
             f.write(f'{key} : {val}')
 
 
-def train_model(args, model, dl_tr, dl_val, dl_ev):
+def train_model(args, model, dl_tr, dl_val, dl_ev, dl_query=None, dl_gallery=None, evaluator=None):
     losses_list = []
-    key_to_opt = f'eval_f1score@7'
+    key_to_opt = f'eval_f1score@{max(args.eval_ks)}'
+    if dl_query is not None:
+        key_to_opt = f'query_recall@1'
     best_recall = pd.DataFrame()
     best_recall[key_to_opt] = [0]
 
@@ -362,59 +551,168 @@ def train_model(args, model, dl_tr, dl_val, dl_ev):
         wandb.log({'loss': losses_list[-1]}, step=epoch)
         scheduler.step()
 
-        if epoch >= 0 and (epoch % 5 == 0 or epoch == args.nb_epochs - 1):
-            with torch.no_grad():
-                val_recalls = evaluate_cos(model, dl_tr, epoch, args, validation=dl_val)
-
-                for key, val in val_recalls.items():
-                    wandb.log({key + '_validation': val.values[0]}, step=epoch)
-                    print(f'{key} : {np.round(val.values[0], 3)}')
-
-                if dl_ev:
-                    test_recalls = evaluate_cos(model, dl_ev, epoch, args)
-
-                    for key, val in test_recalls.items():
-                        wandb.log({key + '_test': val.values[0]}, step=epoch)
-                        print(f'{key} : {np.round(val.values[0], 3)}')
-
-            # Best model save
-            if best_recall[key_to_opt].values[0] < test_recalls[key_to_opt].values[0]:
-                best_recall = test_recalls
-                best_epoch = epoch
-
-                save_dir = '{}/{}_{}'.format(LOG_DIR, wandb.run.name, np.round(best_recall[key_to_opt].values[0], 3))
-                torch_save(save_dir)
-                text_save(test_recalls, best_epoch)
+        if epoch >= 0 and (epoch % args.eval_every == 0 or epoch == args.nb_epochs - 1):
+            if evaluator is None or not evaluator.submit(epoch, model, criterion):
+                val_recalls, test_recalls = evaluate_epoch(model, epoch, args, dl_tr, dl_val, dl_ev,
+                                                           dl_query, dl_gallery)
+                log_recalls(val_recalls, test_recalls, epoch, step=epoch)
+                best_recall = save_if_best(best_recall, key_to_opt, test_recalls, epoch, model.state_dict())
+
+        if evaluator is not None:
+            for eval_epoch, val_recalls, test_recalls, state_dict in evaluator.poll():
+                log_recalls(val_recalls, test_recalls, eval_epoch)
+                best_recall = save_if_best(best_recall, key_to_opt, test_recalls, eval_epoch, state_dict)
+
+    if evaluator is not None:
+        for eval_epoch, val_recalls, test_recalls, state_dict in evaluator.close():
+            log_recalls(val_recalls, test_recalls, eval_epoch)
+            best_recall = save_if_best(best_recall, key_to_opt, test_recalls, eval_epoch, state_dict)
+
+
+def evaluate_epoch(model, epoch, args, dl_tr, dl_val, dl_ev, dl_query=None, dl_gallery=None):
+    val_recalls, test_recalls = None, None
+    with torch.no_grad():
+        if dl_query is not None:
+            test_recalls = evaluate_query_gallery(model, dl_gallery, [dl_query], epoch, args)
+        else:
+            val_recalls = evaluate_cos(model, dl_tr, epoch, args, validation=dl_val)
+            if dl_ev:
+                test_recalls = evaluate_cos(model, dl_ev, epoch, args)
+    return val_recalls, test_recalls
+
+
+def log_recalls(val_recalls, test_recalls, epoch, step=None):
+    # results of the background evaluator arrive epochs later, so they are attached to the
+    # current wandb step (commit=False) together with the epoch they belong to
+    for recalls, suffix in [(val_recalls, '_validation'), (test_recalls, '_test')]:
+        if recalls is None:
+            continue
+        for key, val in recalls.items():
+            if step is None:
+                wandb.log({key + suffix: val.values[0], 'eval_epoch': epoch}, commit=False)
+            else:
+                wandb.log({key + suffix: val.values[0]}, step=step)
+            print(f'{key} : {np.round(val.values[0], 3)}')
+
+
+def save_if_best(best_recall, key_to_opt, test_recalls, epoch, state_dict):
+    # Best model save
+    if test_recalls is not None and best_recall[key_to_opt].values[0] < test_recalls[key_to_opt].values[0]:
+        best_recall = test_recalls
+
+        save_dir = '{}/{}_{}'.format(LOG_DIR, wandb.run.name, np.round(best_recall[key_to_opt].values[0], 3))
+        torch_save(save_dir, state_dict)
+        text_save(test_recalls, epoch)
+    return best_recall
+
+
+def create_embedding_cache(*dataloaders):
+    # a random augmentation would be cached and served as the embedding of the image
+    if not args.embedding_cache or not all(is_deterministic(getattr(dl.dataset, 'transform', None))
+                                           for dl in dataloaders if dl is not None):
+        return None
+    return EmbeddingCache(args.embedding_cache, args.embedding_cache_size)
+
+
+def create_frame_store():
+    if args.eval_format == 'parquet':
+        return FrameStore(f'../training/{args.dataset}/frames/', args.run_name)
+    return None
+
+
+def evaluate_query_gallery(model, dl_gallery, dl_queries, epoch, args):
+    # embed the gallery once, then stream every query set against it
+    dest = f'../training/{args.dataset}/{args.run_name}/{epoch}/query_gallery/'
+    os.makedirs(dest, exist_ok=True)
+
+    store = EmbeddingStore(args.embedding_store) if args.embedding_store else None
+    cache = create_embedding_cache(dl_gallery)
+    X_gallery, T_gallery = utils.predict_or_load(model, dl_gallery, store,
+                                                 checkpoint=f'{args.run_name}_{epoch}',
+                                                 dataset_name=args.dataset, cache=cache)
+    X_gallery = utils.l2_norm(X_gallery)
+
+    metrics = pd.DataFrame(index=[0])
+    for dl_query in dl_queries:
+        recalls = utils.query_gallery_recall(model, dl_query, X_gallery, T_gallery,
+                                             prepend=dl_query.dataset.mode + '_')
+        metrics = pd.concat([metrics, recalls], axis=1)
+
+    frame_store = create_frame_store()
+    if frame_store is not None:
+        frame_store.append('metrics', metrics, epoch, 'query_gallery')
+    else:
+        metrics.to_csv(dest + 'metrics.csv')
+    return metrics
 
 
 def evaluate_cos(model, dataloader, epoch, args, validation=None):
     # calculate embeddings with model and get targets
-    test_dest = f'../training/{args.dataset}/{wandb.run.name}/{epoch}/test/'
-    val_dest = f'../training/{args.dataset}/{wandb.run.name}/{epoch}/validation/'
-    train_dest = f'../training/{args.dataset}/{wandb.run.name}/{epoch}/train_and_validation/'
+    test_dest = f'../training/{args.dataset}/{args.run_name}/{epoch}/test/'
+    val_dest = f'../training/{args.dataset}/{args.run_name}/{epoch}/validation/'
+    train_dest = f'../training/{args.dataset}/{args.run_name}/{epoch}/train_and_validation/'
 
     os.makedirs(train_dest, exist_ok=True)
     os.makedirs(val_dest, exist_ok=True)
     os.makedirs(test_dest, exist_ok=True)
 
-    X, T, Y, neighbors = get_X_T_Y(dataloader, model, validation) # X: Embeddings, T: True Labels,
-                                                                  # Y: True Labels of neighbors
-
-    pictures_to_predict = random.choices(range(len(X)), k=int(round(len(X)*50/100)))
+    store = EmbeddingStore(args.embedding_store) if args.embedding_store else None
+    cache = create_embedding_cache(dataloader, validation)
+    # labels in the order get_X_T_Y embeds them, to choose the evaluated items before the search
+    labels = np.hstack([np.asarray(dl.dataset.ys) for dl in [dataloader, validation] if dl is not None])
+    pictures_to_predict = random.choices(range(len(labels)), k=int(round(len(labels)*50/100)))
     dl_loader = dataloader
     if validation is not None:
-        pictures_to_predict = list(range(len(X) - len(validation.dataset.ys), len(X)))
+        pictures_to_predict = list(range(len(labels) - len(validation.dataset.ys), len(labels)))
         dl_loader = validation
 
-    metrics = f1_score_calc(T, Y, dl_loader, pictures_to_predict)
-    coarse_filter_dict, fine_filter_dict, y_preds, y_true = get_accuracies(T, X, dl_loader,
-                                                                           neighbors, pictures_to_predict, metrics)
-
-    data_viz_frame = create_and_save_viz_frame(X, dataloader, coarse_filter_dict, fine_filter_dict,
+    # a sample only searches neighbours for its items, against every item. It is drawn from the items
+    # a full evaluation predicts, none of which may vote, so both score the same
+    queries = None
+    excluded = np.unique(pictures_to_predict)
+    full_eval = epoch == args.nb_epochs - 1 or (args.full_eval_every > 0 and epoch % args.full_eval_every == 0)
+    if args.eval_sample > 0 and not full_eval:
+        pictures_to_predict = queries = utils.stratified_indices(labels, args.eval_sample, excluded)
+
+    X, T, Y, neighbors = get_X_T_Y(dataloader, model, validation,   # X: Embeddings, T: True Labels,
+                                   store=store,                     # Y: True Labels of neighbors
+                                   checkpoint=f'{args.run_name}_{epoch}',
+                                   dataset_name=args.dataset,
+                                   chunk_size=args.eval_chunk_size,
+                                   index=create_index(),
+                                   cache=cache,
+                                   queries=queries)
+    query_rows = queries is not None
+
+    metrics = f1_score_calc(T, Y, dl_loader, pictures_to_predict, ks=args.eval_ks, query_rows=query_rows)
+    if args.index != 'flat' and args.index_recall > 0:
+        K = neighbors.shape[1]
+        metrics[f'{dl_loader.dataset.mode}_{args.index}_recall_vs_exact@{K}'] = \
+            knn_index.recall_vs_exact(X, neighbors, K, nb_queries=args.index_recall,
+                                      chunk_size=args.eval_chunk_size, queries=queries) * 100
+    hierarchy, y_preds, y_true = get_accuracies(T, X, dl_loader, neighbors, pictures_to_predict, metrics,
+                                                query_rows=query_rows, excluded=excluded)
+    metrics[f'{dl_loader.dataset.mode}_eval_items'] = len(pictures_to_predict)
+    if args.class_eval:
+        # proxies only stand for the classes of the training set, which validation shares
+        proxies = class_proxies(criterion) if validation is not None else None
+        utils.get_class_predictions(T, X, dl_loader, pictures_to_predict, metrics, proxies=proxies,
+                                    knn_preds=y_preds, chunk_size=args.eval_chunk_size)
+    if args.bootstrap > 0:
+        Y_predicted = Y if query_rows else Y[pictures_to_predict]
+        intervals = utils.bootstrap_metrics(T[pictures_to_predict], Y_predicted, args.eval_ks,
+                                            y_preds={'specific': y_preds}, nb_resamples=args.bootstrap,
+                                            prepend=dl_loader.dataset.mode + '_')
+        metrics = pd.concat([metrics, intervals], axis=1)
+
+    frame_store = create_frame_store()
+    data_viz_frame = create_and_save_viz_frame(X, dataloader, hierarchy,
                                                pictures_to_predict,
                                                train_dest, val_dest, test_dest,
-                                               y_preds, y_true)
+                                               y_preds, y_true, frame_store, epoch)
 
+    renderer = plots.get_renderer(args.plots, args.plot_processes,
+                                  cache_dir=f'../training/{args.dataset}/plot_cache/')
     with warnings.catch_warnings():
         warnings.simplefilter('ignore')
         params = ['prediction', 'truth']
@@ -423,19 +721,19 @@ def evaluate_cos(model, dataloader, epoch, args, validation=None):
             for para in params:
                 try:
                     plot_relationships(X, data_viz_frame, dataloader, deg, para, pictures_to_predict,
-                                       train_dest, val_dest, test_dest)
+                                       train_dest, val_dest, test_dest, renderer)
 
                 except Exception:
                     import traceback
                     print(traceback.format_exc())
                     print('WARNING: Cant create Graph')
     try:
-        confusion_matrices(data_viz_frame, dataloader, train_dest, val_dest, test_dest)
+        confusion_matrices(data_viz_frame, dataloader, train_dest, val_dest, test_dest, renderer)
     except Exception:
         import traceback
         print(traceback.format_exc())
 
-    save_metrics(dataloader, metrics, train_dest, val_dest, test_dest)
+    save_metrics(dataloader, metrics, train_dest, val_dest, test_dest, frame_store, epoch)
 
     return metrics
 
@@ -462,16 +760,30 @@ if __name__ == '__main__':
     wandb.login(key='f0a1711b34f7b07e32150c85c67697eb82c5120f')
     wandb.init(project=args.dataset + '_ProxyAnchor', notes=LOG_DIR)
     wandb.config.update(args)
+    args.run_name = wandb.run.name
 
     os.chdir('../data/')
     data_root = os.getcwd()
 
-    dl_tr, dl_val, dl_ev = create_generators()
+    dl_query, dl_gallery = None, None
+    if args.dataset == 'Inshop':
+        dl_tr, dl_query, dl_gallery = create_inshop_generators()
+        dl_val, dl_ev = None, None
+    else:
+        dl_tr, dl_val, dl_ev = create_generators()
     nb_classes = dl_tr.dataset.nb_classes()
 
     criterion = create_loss(nb_classes)
+    if args.proxy_init:
+        init_proxies(criterion, dl_tr)
     opt, scheduler = create_optimizer_and_prepare_layers()
 
+    evaluator = None
+    if args.async_eval:
+        evaluator = EvaluationWorker(args, [dl_tr, dl_val, dl_ev, dl_query, dl_gallery],
+                                     max_pending=args.async_eval_queue)
+
     print("Training for {} epochs.".format(args.nb_epochs))
-    train_model(args, model, dl_tr, dl_val, dl_ev)
+    train_model(args, model, dl_tr, dl_val, dl_ev, dl_query, dl_gallery, evaluator)
+    plots.close_renderer()
 
@@ -1,30 +1,28 @@
 import os
 import functools
-import traceback
 import uuid
 import math
-import itertools
 import warnings
 from collections import Counter
-from operator import itemgetter
 import pandas as pd
 import numpy as np
 import random
 
 import torch
 from matplotlib.colors import ListedColormap
-import networkx as nx
 
-from scipy.spatial import distance_matrix
 from sklearn.decomposition import KernelPCA
-from sklearn.metrics import f1_score, accuracy_score, confusion_matrix
-from sklearn.preprocessing import MinMaxScaler
+from sklearn.metrics import f1_score, accuracy_score
 
 import torch.nn.functional as F
 
 from tqdm import tqdm
 
-import seaborn as sns
+import plots
+from confusion import ConfusionCounts
+from dataset.base import LabelHierarchy
+from similarity import l2_normalize, pairwise_similarity, paired_similarity
+
 import matplotlib.pyplot as plt
 
 plt.ioff()
@@ -64,82 +62,113 @@ def combine_dims(a, i=0, n=1):
 
 
 
-def predict_batchwise(model, train_gen, return_images=False):
+def sequential_loader(dataloader, indices=None):
+    """
+    Rebuilds `dataloader` so it walks the whole dataset (or only `indices` of it) once, in order,
+    without shuffling or dropping the last partial batch. Worker and pinning settings are kept.
+    """
+    dataset = dataloader.dataset
+    if indices is not None:
+        dataset = torch.utils.data.Subset(dataset, indices)
+
+    kwargs = {}
+    if dataloader.num_workers > 0:
+        kwargs['prefetch_factor'] = dataloader.prefetch_factor
+        kwargs['persistent_workers'] = dataloader.persistent_workers
+    return torch.utils.data.DataLoader(
+        dataset,
+        batch_size=dataloader.batch_size,
+        shuffle=False,
+        drop_last=False,
+        num_workers=dataloader.num_workers,
+        pin_memory=dataloader.pin_memory,
+        **kwargs
+    )
+
+
+def predict_batchwise(model, train_gen, return_images=False, cache=None):
+    """
+    Streams every item of `train_gen.dataset` through `model`.
+    Returns [X, T] (or [X, T, images]) where X : [nb_samples x sz_embedding] float32,
+    T : [nb_samples] int64, both in dataset order.
+    With an EmbeddingCache, items already embedded by the same weights are served from the
+    cache without being loaded; the others are embedded and added to it.
+    """
     model_is_training = model.training
     model.eval()
 
-    batch_sz = train_gen.batch_size
-    num_batches = train_gen.dataset.__len__()
-
-    predictions = np.zeros((num_batches, batch_sz, train_gen.dataset.sz_embedding))
-    labels = np.zeros((num_batches, batch_sz))
+    dataset = train_gen.dataset
+    nb_samples = len(dataset)
+    device = next(model.parameters()).device
+
+    predictions = None
+    labels = np.zeros(nb_samples, dtype=np.int64)
+    image_array = None
+
+    rows = np.arange(nb_samples)
+    if cache is not None and not return_images:
+        keys = cache.keys(model, dataset)
+        cached = cache.get_many(keys)
+        if cached:
+            hit_rows = np.array([i for i, key in enumerate(keys) if key in cached], dtype=np.int64)
+            predictions = np.zeros((nb_samples, len(cached[keys[hit_rows[0]]])), dtype=np.float32)
+            predictions[hit_rows] = np.stack([cached[keys[i]] for i in hit_rows])
+            labels[hit_rows] = np.asarray(dataset.ys)[hit_rows]
+            rows = np.array([i for i, key in enumerate(keys) if key not in cached], dtype=np.int64)
+
+    start = 0
+    if len(rows):
+        loader = sequential_loader(train_gen, rows if len(rows) < nb_samples else None)
+        with torch.no_grad():
+            for x, y in tqdm(loader, desc='Extracting Batches'):
+                batch_rows = rows[start:start + len(y)]
+                J = model(x.to(device, non_blocking=True)).cpu().numpy()
+                if predictions is None:
+                    predictions = np.zeros((nb_samples, J.shape[1]), dtype=np.float32)
+                predictions[batch_rows] = J
+                labels[batch_rows] = y.numpy()
+
+                if return_images:
+                    if image_array is None:
+                        image_array = np.zeros((nb_samples, *x.shape[1:]), dtype=np.float32)
+                    image_array[batch_rows] = x.numpy()
+                start += len(y)
+
+    if cache is not None and not return_images and len(rows):
+        cache.put_many([keys[i] for i in rows], predictions[rows])
 
-    if return_images:
-        # TODO add a attribute to dataloader that gives the shape
-        # image_array = np.zeros((len(dataloader.dataset.im_paths), 3, 224, 224))
-        image_array = np.zeros((num_batches, batch_sz, *train_gen.dataset.im_dimensions))
-
-
-    missing_batch = 0
-
-    with torch.no_grad():
-        # extract batches (A becomes list of samples)
-        for idx in tqdm(range(num_batches), desc='Extracting Batches'):
-            batch = train_gen.dataset.__getitem__(idx)
-            for i, J in enumerate(batch):
-                # i = 0: sz_batch * images
-                # i = 1: sz_batch * labels
-                # i = 2: sz_batch * indices
-                if len(J) != batch_sz:
-                    filled_batch = np.array(J, dtype=np.float32)
-                    empty_batch = np.zeros((batch_sz - len(J), *filled_batch.shape[1::]), dtype=np.float32)
-                    missing_batch = len(empty_batch)
-
-                    if i == 1:
-                        J = np.hstack((filled_batch, empty_batch))
-                    else:
-                        J = np.vstack((filled_batch, empty_batch))
-
-                if i == 0:
-                    if return_images:
-                        image_array[i, :] = J
-
-                    # move images to device of model (approximate device)
-                    J = model(torch.from_numpy(J).float())   # Second arg is a dummy input
-                    # because its not in training mode
-                    predictions[idx, :] = J
-                else:
-                    labels[idx, :] = J
-
-    model.train()
     model.train(model_is_training)  # revert to previous training state
 
-    if not missing_batch:
-        missing_batch = -1 * num_batches * batch_sz
-
-
-    if return_images:
-        image_array = combine_dims(image_array, 0, 1)
-        image_array = image_array[0:-missing_batch, :]
-
-    predictions = combine_dims(predictions, 0, 1)
-    predictions = predictions[0:-missing_batch, :]
-
-    labels = combine_dims(labels, 0, 1)
-    labels = labels[0:-missing_batch]
-
     if return_images:
         return [predictions, labels, image_array]
     return [predictions, labels]
 
 
 def proxy_init_calc(model, dataloader):
+    """
+    Mean embedding of every class of `dataloader.dataset` from one pass over it, accumulated with
+    index_add so no embedding is kept.
+    Returns (l2 normalised means [nb_classes x sz_embedding], counts [nb_classes]); classes without
+    items get a zero mean and count 0.
+    """
+    model_is_training = model.training
+    model.eval()
     nb_classes = dataloader.dataset.nb_classes()
-    X, T, *_ = predict_batchwise(model, dataloader)
+    device = next(model.parameters()).device
 
-    proxy_mean = torch.stack([X[T == class_idx].mean(0) for class_idx in range(nb_classes)])
+    sums = None
+    counts = torch.zeros(nb_classes, dtype=torch.long, device=device)
+    with torch.no_grad():
+        for x, y in tqdm(sequential_loader(dataloader), desc='Class means'):
+            J = model(x.to(device, non_blocking=True)).float()
+            y = torch.as_tensor(y).to(device).long()
+            if sums is None:
+                sums = torch.zeros((nb_classes, J.shape[1]), device=device)
+            sums.index_add_(0, y, J)
+            counts += torch.bincount(y, minlength=nb_classes)
 
-    return proxy_mean
+    model.train(model_is_training)  # revert to previous training state
+    return l2_normalize(sums / counts.clamp(min=1)[:, None]).cpu(), counts.cpu()
 
 
 def parse_im_name(specific_species, exclude_trailing_consonants=False, fine=False):
@@ -156,21 +185,110 @@ def parse_im_name(specific_species, exclude_trailing_consonants=False, fine=Fals
             filter = filter[0:-1]
     return filter
 
-def transform_generator(dataloader, model, k=32):
-    X, T, _ = predict_batchwise(model, dataloader, return_images=False)
+def topk_neighbours(X, k, chunk_size=4096, queries=None):
+    """
+    X : [nb_samples x sz_embedding] l2 normalised embeddings (torch tensor)
+    queries : positions of the rows to search neighbours for, all rows by default
+    Returns [nb_queries x k] indices of the k most cosine-similar other rows, same as
+    F.linear(X, X).topk(1 + k)[1][:, 1:] but only `chunk_size` rows of the similarity
+    matrix are held in memory at a time.
+    """
+    Q = X if queries is None else X[torch.as_tensor(queries)]
+    neighbors = torch.empty((len(Q), k), dtype=torch.long)
+    for start in range(0, len(Q), chunk_size):
+        cos_sim = F.linear(Q[start:start + chunk_size], X)
+        neighbors[start:start + len(cos_sim)] = cos_sim.topk(1 + k)[1][:, 1:]
+    return neighbors
+
+
+def blocked_topk(Q, G, k, chunk_size=65536):
+    """
+    Q : [nb_queries x sz_embedding], G : [nb_gallery x sz_embedding] l2 normalised embeddings
+    Returns the [nb_queries x k] similarities and indices of the most cosine-similar gallery rows,
+    scanning the gallery `chunk_size` rows at a time and merging the running top-k.
+    """
+    k = min(k, len(G))
+    best_sims = torch.full((len(Q), k), -float('inf'), dtype=Q.dtype)
+    best_idx = torch.full((len(Q), k), -1, dtype=torch.long)
+    for start in range(0, len(G), chunk_size):
+        block = G[start:start + chunk_size]
+        sims = torch.cat((best_sims, F.linear(Q, block)), dim=1)
+        idx = torch.cat((best_idx, torch.arange(start, start + len(block)).expand(len(Q), -1)), dim=1)
+        best_sims, pos = sims.topk(k)
+        best_idx = torch.gather(idx, 1, pos)
+    return best_sims, best_idx
+
+
+def query_gallery_recall(model, dl_query, X_gallery, T_gallery, ks=(1, 10, 20, 30, 40, 50), chunk_size=65536,
+                         prepend=''):
+    """
+    Streams the batches of `dl_query` through `model` and searches each against the (l2 normalised)
+    gallery embeddings block by block. Returns a one row DataFrame with recall@k for every k in ks,
+    the query embeddings are never held all at once.
+    """
+    model_is_training = model.training
+    model.eval()
+    device = next(model.parameters()).device
+
+    X_gallery = torch.as_tensor(np.asarray(X_gallery)).float()
+    T_gallery = torch.as_tensor(np.asarray(T_gallery)).long()
+    hits = {k: 0 for k in ks}
+    nb_queries = 0
+    with torch.no_grad():
+        for x, y in tqdm(sequential_loader(dl_query), desc='Querying Gallery'):
+            q = F.normalize(model(x.to(device, non_blocking=True)).cpu().float(), dim=1)
+            _, idx = blocked_topk(q, X_gallery, max(ks), chunk_size)
+            match = T_gallery[idx] == y.long()[:, None]
+            for k in ks:
+                hits[k] += match[:, :k].any(dim=1).sum().item()
+            nb_queries += len(y)
+
+    model.train(model_is_training)  # revert to previous training state
+
+    metrics = pd.DataFrame(index=[0])
+    for k in ks:
+        metrics[f'{prepend}recall@{k}'] = 100 * hits[k] / nb_queries
+    return metrics
+
+
+def transform_generator(dataloader, model, k=32, chunk_size=4096):
+    X, T = predict_batchwise(model, dataloader, return_images=False)
     X = l2_norm(X)
     # get predictions by assigning nearest 8 neighbors with cosine
-    cos_sim = F.linear(torch.from_numpy(X), torch.from_numpy(X))
-    neighbors = cos_sim.topk(1 + k)[1][:, 1:]
+    neighbors = topk_neighbours(torch.from_numpy(X), k, chunk_size)
     Y = T[neighbors]
     return T, X, Y, neighbors.numpy()
 
 
-def get_X_T_Y(dataloader, model, validation):
-    X, T = predict_batchwise(model, dataloader, return_images=False)
+def predict_or_load(model, dataloader, store=None, checkpoint=None, dataset_name=None, cache=None):
+    """
+    predict_batchwise, but reads the embeddings from `store` (an EmbeddingStore) when
+    (checkpoint, dataset_name, mode) was already saved, and saves them there otherwise.
+    """
+    if store is None:
+        return predict_batchwise(model, dataloader, return_images=False, cache=cache)
+
+    mode = dataloader.dataset.mode
+    if store.has(checkpoint, dataset_name, mode):
+        X, T, _ = store.load(checkpoint, dataset_name, mode)
+        return [X, np.array(T)]
+
+    X, T = predict_batchwise(model, dataloader, return_images=False, cache=cache)
+    store.save(checkpoint, dataset_name, mode, X, T, im_paths=getattr(dataloader.dataset, 'im_paths', None))
+    return [X, T]
+
+
+def get_X_T_Y(dataloader, model, validation, store=None, checkpoint=None, dataset_name=None, chunk_size=4096,
+              index=None, cache=None, queries=None):
+    """
+    Embeddings X and labels T of every item of `dataloader` (and `validation`), and the labels Y and
+    positions of their nearest neighbours. With `queries` (positions in X) only those rows are searched,
+    every item stays searchable; Y and neighbors then have one row per query.
+    """
+    X, T = predict_or_load(model, dataloader, store, checkpoint, dataset_name, cache)
 
     if validation is not None:
-        X2, T2 = predict_batchwise(model, validation, return_images=False)
+        X2, T2 = predict_or_load(model, validation, store, checkpoint, dataset_name, cache)
         X = np.vstack((X, X2))
         T = np.hstack((T, T2))
 
@@ -180,8 +298,11 @@ def get_X_T_Y(dataloader, model, validation):
     # get predictions by assigning nearest 8 neighbors with cosine
 
     K = min(32, len(X) - 1)
-    cos_sim = F.linear(X, X)
-    neighbors = cos_sim.topk(1 + K)[1][:, 1:]
+    if index is None:
+        neighbors = topk_neighbours(X, K, chunk_size, queries)
+    else:
+        index.add(X)
+        neighbors = index.neighbours(X, K, queries)
 
     Y = T[neighbors]
     Y = Y.float().cpu()
@@ -190,7 +311,10 @@ def get_X_T_Y(dataloader, model, validation):
     return X, T, Y, neighbors
 
 
-def save_metrics(dataloader, metrics, train_dest, val_dest, test_dest):
+def save_metrics(dataloader, metrics, train_dest, val_dest, test_dest, frame_store=None, epoch=None):
+    if frame_store is not None:
+        frame_store.append('metrics', metrics, epoch, dataloader.dataset.mode)
+        return
     if dataloader.dataset.mode == 'train':
         metrics.to_csv(train_dest + 'metrics.csv')
     if dataloader.dataset.mode == 'validation':
@@ -198,20 +322,23 @@ def save_metrics(dataloader, metrics, train_dest, val_dest, test_dest):
     if dataloader.dataset.mode == 'eval':
         metrics.to_csv(test_dest + 'metrics.csv')
 
-def confusion_matrices(data_viz_frame, dataloader, train_dest, val_dest, test_dest):
+def confusion_matrices(data_viz_frame, dataloader, train_dest, val_dest, test_dest, renderer=None):
     if dataloader.dataset.mode == 'train':
-        plot_confusion(data_viz_frame, dataloader, train_dest)
+        plot_confusion(data_viz_frame, dataloader, train_dest, renderer)
     if dataloader.dataset.mode == 'validation':
-        plot_confusion(data_viz_frame, dataloader, val_dest)
+        plot_confusion(data_viz_frame, dataloader, val_dest, renderer)
     if dataloader.dataset.mode == 'eval':
-        plot_confusion(data_viz_frame, dataloader, test_dest)
+        plot_confusion(data_viz_frame, dataloader, test_dest, renderer)
 
-def create_and_save_viz_frame(X, dataloader, coarse_filter_dict, fine_filter_dict,
+def create_and_save_viz_frame(X, dataloader, hierarchy,
                               pictures_to_predict,
                               train_dest, val_dest, test_dest,
-                              y_preds, y_true):
-    data_viz_frame = form_data_viz_frame(X[pictures_to_predict], coarse_filter_dict, fine_filter_dict,
-                                         dataloader, y_preds, y_true)
+                              y_preds, y_true, frame_store=None, epoch=None):
+    data_viz_frame = form_data_viz_frame(X[pictures_to_predict], hierarchy, y_preds, y_true)
+
+    if frame_store is not None:
+        frame_store.append('predictions', data_viz_frame, epoch, dataloader.dataset.mode)
+        return data_viz_frame
 
     if dataloader.dataset.mode == 'train':
         data_viz_frame.to_csv(train_dest + 'train_and_validation_data_combined.csv')
@@ -223,210 +350,382 @@ def create_and_save_viz_frame(X, dataloader, coarse_filter_dict, fine_filter_dic
 
 
 def plot_relationships(X, data_viz_frame, dataloader, deg, para, pictures_to_predict,
-                       train_dest, val_dest, test_dest):
+                       train_dest, val_dest, test_dest, renderer=None):
     if dataloader.dataset.mode == 'train':
-        plot_node_graph(X[pictures_to_predict], data_viz_frame, para, deg, train_dest)
+        plot_node_graph(X[pictures_to_predict], data_viz_frame, para, deg, train_dest, renderer)
     if dataloader.dataset.mode == 'validation':
-        plot_node_graph(X[pictures_to_predict], data_viz_frame, para, deg, val_dest)
+        plot_node_graph(X[pictures_to_predict], data_viz_frame, para, deg, val_dest, renderer)
     if dataloader.dataset.mode == 'eval':
-        plot_node_graph(X[pictures_to_predict], data_viz_frame, para, deg, test_dest)
+        plot_node_graph(X[pictures_to_predict], data_viz_frame, para, deg, test_dest, renderer)
 
 
-def calc_recall(T, Y, k):
+def neighbour_label_modes(Y, ks, chunk_size=4096):
+    """
+    Y : [nb_samples x K] labels of the K nearest neighbours
+    Returns {k: [nb_samples] most frequent label among the first k neighbours} for every k in ks,
+    smallest label on ties (same as torch.mode).
+    """
+    Y = np.asarray(Y).astype(np.int64)
+    modes = {k: np.zeros(len(Y), dtype=np.int64) for k in ks}
+    for start in range(0, len(Y), chunk_size):
+        y = Y[start:start + chunk_size]
+        # votes[p, i, k - 1]: how often y[p, i] occurs among the first k neighbours of p
+        votes = np.cumsum(y[:, :, None] == y[:, None, :], axis=2, dtype=np.int16)
+        for k in ks:
+            votes_k = votes[:, :k, k - 1]
+            is_mode = votes_k == votes_k.max(axis=1, keepdims=True)
+            modes[k][start:start + len(y)] = np.where(is_mode, y[:, :k], np.iinfo(np.int64).max).min(axis=1)
+    return modes
+
+
+def retrieval_metrics(T, Y, ks, T_gallery=None, prepend=''):
     """
         T : [nb_samples] (target labels)
-        Y : [nb_samples x k] (k predicted labels/neighbours)
-        """
+        Y : [nb_samples x K] (K predicted labels/neighbours)
+        T_gallery : labels of every searchable item, needed for MAP@R and R-precision
+                    (R = number of other gallery items of the query's class, capped at K)
+    Returns a one row DataFrame with recall@k and f1score@k (weighted F1 of the neighbour
+    mode) for every k in ks, plus MAP@R and R_precision, and {k: predicted labels}.
+    """
+    T = np.asarray(T).astype(np.int64)
+    Y = np.asarray(Y).astype(np.int64)
+    K = Y.shape[1]
+    ks = [k for k in ks if k <= K]
+
+    metrics = pd.DataFrame(index=[0])
+    y_preds = neighbour_label_modes(Y, ks)
+    hits = Y == T[:, None]
+    for k in ks:
+        metrics[f'{prepend}recall@{k}'] = hits[:, :k].any(axis=1).mean() * 100
+        metrics[f'{prepend}f1score@{k}'] = f1_score(T, y_preds[k], average='weighted') * 100
+
+    if T_gallery is not None:
+        labels, counts = np.unique(np.asarray(T_gallery).astype(np.int64), return_counts=True)
+        pos = np.clip(np.searchsorted(labels, T), 0, len(labels) - 1)
+        R = np.where(labels[pos] == T, counts[pos] - 1, 0)
+        R = np.minimum(R, K)
+        has_R = R > 0
+
+        relevant = hits & (np.arange(K)[None, :] < R[:, None])
+        precision_at_i = np.cumsum(relevant, axis=1) / np.arange(1, K + 1)
+        metrics[f'{prepend}MAP@R'] = ((precision_at_i * relevant).sum(axis=1)[has_R] / R[has_R]).mean() * 100
+        metrics[f'{prepend}R_precision'] = (relevant.sum(axis=1)[has_R] / R[has_R]).mean() * 100
+
+    return metrics, y_preds
+
 
 def calc_recall(T, Y, k, prepend=''):
-    metrics = pd.DataFrame()
-    y_preds = []
-    for t, y in zip(T, Y):
-        y_preds.append(torch.mode(torch.Tensor(y).long()[:k]).values)
-    y_preds = np.array(y_preds).astype(int)
-    y_true = np.array(T)
-    r_at_k = f1_score(y_true, y_preds, average='weighted')
-    metrics[f'{prepend}f1score@{k}'] = [r_at_k * 100]
-    return y_preds, y_true, metrics
+    metrics, y_preds = retrieval_metrics(T, Y, [k], prepend=prepend)
+    return y_preds[k], np.asarray(T).astype(int), metrics[[f'{prepend}f1score@{k}']]
 
 
-def plot_confusion(data_viz_frame, dataloader, dest):
-    params = ['label_coarse', 'label_fine', 'denom']
-    if 'NoteStyles' != dataloader.dataset.name:
-        params = ['label_coarse', 'label_fine']
+def plot_confusion(data_viz_frame, dataloader, dest, renderer=None, top_n=50, max_heatmap_labels=150):
+    """
+    Saves the `top_n` most frequent confusions of every label level to
+    `top_confusions_<level>.csv`, and the full heatmap for levels with at most
+    `max_heatmap_labels` labels.
+    """
+    params = [param for param in ['label_coarse', 'label_fine', 'denom'] if f'truth_{param}' in data_viz_frame]
 
     for param in params:
-        fig = plt.Figure(figsize=(48, 48))
-        ax = plt.subplot()
-        annot = True
-        if param == 'label_fine':
-            annot = False
-        sns.heatmap(confusion_matrix(data_viz_frame[f'prediction_{param}'].values,
-                                     data_viz_frame[f'truth_{param}'].values),
-                    annot=annot, fmt='g', ax=ax,
-                    annot_kws={"size": 4})  # annot=True to annotate cells, ftm='g' to disable scientific notation
-
-        # labels, title and ticks
-        ax.set_xlabel('Predicted labels')
-        ax.set_ylabel('True labels')
-        ax.set_title(f'Confusion Matrix for {param}')
-        ax.xaxis.set_ticklabels(np.unique(data_viz_frame[f'prediction_{param}'].values))
-        ax.yaxis.set_ticklabels(np.unique(data_viz_frame[f'truth_{param}'].values))
-        plt.savefig(dest + f'Confusion_{param}.png', bbox_inches='tight', dpi=300)
-        plt.close()
-
-
-def form_data_viz_frame(X, coarse_filter_dict, fine_filter_dict, dataloader, y_preds, y_true):
+        truth = pd.Categorical(data_viz_frame[f'truth_{param}'])
+        prediction = pd.Categorical(data_viz_frame[f'prediction_{param}'], categories=truth.categories)
+        # only the labels that occur, in vocabulary order
+        known = (truth.codes >= 0) & (prediction.codes >= 0)
+        used, codes = np.unique(np.concatenate((truth.codes[known], prediction.codes[known])), return_inverse=True)
+        confusion = ConfusionCounts(truth.categories[used])
+        confusion.update_codes(codes[:known.sum()], codes[known.sum():])
+        confusion.top_confusions(top_n).to_csv(dest + f'top_confusions_{param}.csv', index=False)
+
+        if len(confusion) > max_heatmap_labels:
+            continue
+        # rows: true labels, columns: predicted labels
+        inputs_path = plots.save_plot_inputs(dest + f'Confusion_{param}.png', 'confusion',
+                                             labels=np.asarray(confusion.labels).astype(str),
+                                             counts=confusion.dense(), param=np.array(param))
+        (renderer or plots.get_renderer()).submit(inputs_path)
+
+
+def label_hierarchy(dataset):
+    """ The dataset's LabelHierarchy, built from its class name dicts if it has none. """
+    hierarchy = getattr(dataset, 'hierarchy', None)
+    if hierarchy is None:
+        hierarchy = LabelHierarchy(dataset.class_names_fine_dict, dataset.class_names_coarse_dict,
+                                   with_denom=getattr(dataset, 'name', None) == 'note_styles')
+    return hierarchy
+
+
+def form_data_viz_frame(X, hierarchy, y_preds, y_true):
+    """
+    One row per prediction with the true and predicted class ids and their label at every level
+    of `hierarchy` (categorical columns truth_label_coarse, prediction_label_fine, truth_denom, ...).
+    """
     data_viz_frame = pd.DataFrame(y_true.astype(int), columns=['truth'])
     data_viz_frame['prediction'] = y_preds
 
-    data_viz_frame['truth_label_coarse'] = data_viz_frame['truth'].map(coarse_filter_dict, y_true)
-    data_viz_frame['truth_label_fine'] = data_viz_frame['truth'].map(fine_filter_dict, y_true)
-
-    data_viz_frame['prediction_label_coarse'] = data_viz_frame['prediction'].map(coarse_filter_dict, y_preds)
-    data_viz_frame['prediction_label_fine'] = data_viz_frame['prediction'].map(fine_filter_dict, y_preds)
-
-    if 'NoteStyles' == dataloader.dataset.name:
-        data_viz_frame['truth_denom'] = [label.split('_')[0] for label in data_viz_frame['truth_label_fine']]
-        data_viz_frame['prediction_denom'] = [label.split('_')[0] for label in data_viz_frame['prediction_label_fine']]
+    columns = {'coarse': 'label_coarse', 'fine': 'label_fine', 'denom': 'denom'}
+    for level in ['coarse', 'fine', 'denom']:
+        if level in hierarchy.levels:
+            data_viz_frame[f'truth_{columns[level]}'] = hierarchy.categorical(y_true, level)
+            data_viz_frame[f'prediction_{columns[level]}'] = hierarchy.categorical(y_preds, level)
     data_viz_frame['mean_coarse'] = X.mean(axis=1)
     return data_viz_frame
 
 
-def stratified_sample_df(df, col, n_samples):
+def stratified_sample_df(df, col, n_samples, random_state=None):
     n = min(n_samples, df[col].value_counts().min())
-    df_ = df.groupby(col).apply(lambda x: x.sample(n))
+    df_ = df.groupby(col).apply(lambda x: x.sample(n, random_state=random_state))
     df_.index = df_.index.droplevel(0)
     return df_
 
 
-def plot_node_graph(X, data_viz_frame, para, deg, dest):
+def stratified_indices(T, n_samples, candidates=None, seed=0):
+    """
+    Sorted positions (among `candidates`, all of T by default) of the same number of items of
+    every class: n_samples, or the size of the smallest class if that is smaller. The same seed
+    gives the same sample every epoch.
+    """
+    candidates = np.arange(len(T)) if candidates is None else np.asarray(candidates)
+    df = pd.DataFrame({'label': np.asarray(T)[candidates]}, index=candidates)
+    return np.sort(stratified_sample_df(df, 'label', n_samples, random_state=seed).index.values)
+
+
+def _weighted_f1(weights, truth, preds, nb_classes):
+    """ sklearn's f1_score(average='weighted') for every row of sample weights [B x n] at once. """
+    B = len(weights)
+    offsets = np.arange(B)[:, None] * nb_classes
+    correct = weights * (truth == preds)
+    support = np.bincount((offsets + truth).ravel(), weights.ravel(), B * nb_classes).reshape(B, -1)
+    predicted = np.bincount((offsets + preds).ravel(), weights.ravel(), B * nb_classes).reshape(B, -1)
+    tp = np.bincount((offsets + truth).ravel(), correct.ravel(), B * nb_classes).reshape(B, -1)
+
+    denom = support + predicted
+    f1 = np.divide(2 * tp, denom, out=np.zeros_like(tp), where=denom > 0)
+    return (f1 * support).sum(axis=1) / support.sum(axis=1)
+
+
+def bootstrap_metrics(T, Y, ks, y_preds=None, nb_resamples=1000, confidence=0.95, chunk_size=100, seed=0,
+                      prepend=''):
+    """
+    Percentile bootstrap confidence intervals of recall@k and f1score@k (as in retrieval_metrics)
+    and, if `y_preds` ({name: [nb_samples] predicted labels}) is given, of the accuracy of every
+    prediction. Items are resampled with replacement `nb_resamples` times; the neighbour labels Y
+    are reused, nothing is searched again.
+    Returns a one row DataFrame with `<metric>_ci_low` and `<metric>_ci_high` columns.
+    """
+    T = np.asarray(T).astype(np.int64)
+    Y = np.asarray(Y).astype(np.int64)
+    ks = [k for k in ks if k <= Y.shape[1]]
+    y_preds = y_preds or {}
+
+    modes = neighbour_label_modes(Y, ks)
+    labels = np.unique(np.concatenate([T] + [modes[k] for k in ks]))
+    truth = np.searchsorted(labels, T)
+    modes = {k: np.searchsorted(labels, modes[k]) for k in ks}
+    hits = Y == T[:, None]
+
+    scores = {}
+    for k in ks:
+        scores[f'{prepend}recall@{k}'] = hits[:, :k].any(axis=1)
+    for name, preds in y_preds.items():
+        scores[f'{prepend}{name}_accuracy'] = np.asarray(preds).astype(np.int64) == T
+    scores = {name: score.astype(np.float64) for name, score in scores.items()}
+    resampled = {name: [] for name in list(scores) + [f'{prepend}f1score@{k}' for k in ks]}
+
+    rng = np.random.default_rng(seed)
+    n = len(T)
+    for start in range(0, nb_resamples, chunk_size):
+        B = min(chunk_size, nb_resamples - start)
+        draws = rng.integers(0, n, (B, n)) + np.arange(B)[:, None] * n
+        weights = np.bincount(draws.ravel(), minlength=B * n).reshape(B, n).astype(np.float64)
+        for name, score in scores.items():
+            resampled[name].append(weights @ score / n)
+        for k in ks:
+            resampled[f'{prepend}f1score@{k}'].append(_weighted_f1(weights, truth, modes[k], len(labels)))
+
+    alpha = (1 - confidence) / 2 * 100
+    intervals = pd.DataFrame(index=[0])
+    for name, values in resampled.items():
+        low, high = np.percentile(np.concatenate(values) * 100, [alpha, 100 - alpha])
+        intervals[f'{name}_ci_low'] = low
+        intervals[f'{name}_ci_high'] = high
+    return intervals
+
+
+def plot_node_graph(X, data_viz_frame, para, deg, dest, renderer=None, num_nbors=1, max_dist=0.6):
+    """
+    Links every class centroid to its `num_nbors` closest other centroids whose distance, divided
+    by the largest centroid distance, is below `max_dist`. Only the edge list is handed to
+    networkx, for the layout.
+    """
     # TODO make this works for individual points
-    centroids = {}
-    full_items = []
-    for idx, (coarse, frame) in enumerate(data_viz_frame.groupby(f'{para}_label_{deg}')):
-        centroids[coarse] = X[frame.index].mean(axis=0)
-
-        for note in frame.index:
-            full_items.append((coarse, *X[note]))
-
-    centroids_af = pd.DataFrame(centroids).T
-    dst_matrix = distance_matrix(centroids_af, centroids_af, p=0.1)
-
-    sca = MinMaxScaler()
-    dst_matrix = sca.fit_transform(dst_matrix)
-    fig = plt.Figure(figsize=(120, 60))
-
-    G = nx.from_numpy_matrix(dst_matrix)
-
-    weight_dict = {}
-    for (i, j) in itertools.permutations(range(len(G.nodes)), 2):
-        if i not in weight_dict.keys():
-            weight_dict[i] = {}
-        weight_dict[i][j] = G.get_edge_data(i, j)['weight']
-
-    G = nx.create_empty_copy(G)
-
-    num_nbors = 1
-    for i in range(len(G.nodes)):
-        try:
-            res = dict(sorted(weight_dict[i].items(), key=itemgetter(1))[:num_nbors])
-        except Exception:
-            print(traceback.format_exc())
-            print(weight_dict.keys())
-            print(G.nodes)
-        small_edges = [key for key, val in res.items() if val < 0.6]
-
-        for edg in small_edges:
-            if i == edg:
-                print(small_edges)
-                print(i)
-            G.add_edge(i, edg, weight=weight_dict[i][edg])
-
-    G = nx.relabel_nodes(G, dict(zip(range(len(G.nodes())),
-                                     [i for i in centroids_af.index])))
-
-    pos = nx.spring_layout(G)
-
-    nx.draw_networkx_labels(G, pos=pos, bbox=dict(
-        boxstyle='round', ec=(0.0, 0.0, 0.0),
-        alpha=0.9, fc='white', lw=1.5
-    ),
-                            verticalalignment='center', ax=fig.add_subplot(111))
-    nx.draw(G, node_size=600, pos=pos, with_labels=False, ax=fig.add_subplot(111))
-    plt.show(block=False)
-    fig.savefig(f'{dest}{para}_{deg}_graph.png', bbox_inches='tight', dpi=200)
-    return centroids
+    codes, labels = pd.factorize(data_viz_frame[f'{para}_label_{deg}'], sort=True)
+    rows = torch.as_tensor(data_viz_frame.index.values[codes >= 0])
+    codes = torch.as_tensor(codes[codes >= 0])
+
+    X = torch.as_tensor(X)[rows].float()
+    sums = torch.zeros((len(labels), X.shape[1])).index_add_(0, codes, X)
+    centroids = sums / torch.bincount(codes, minlength=len(labels))[:, None]
+
+    dst_matrix = pairwise_similarity(centroids, metric='euclidean').numpy()
+    dst_matrix /= max(dst_matrix.max(), 1e-12)
+    np.fill_diagonal(dst_matrix, np.inf)
+
+    num_nbors = min(num_nbors, len(labels) - 1)
+    if num_nbors > 0:
+        nbors = np.argpartition(dst_matrix, num_nbors - 1, axis=1)[:, :num_nbors]
+        src = np.repeat(np.arange(len(labels)), num_nbors)
+        nbors = nbors.flatten()
+        weights = dst_matrix[src, nbors]
+        close = weights < max_dist
+
+        # undirected: a pair that are each other's neighbours is kept once
+        pairs, first = np.unique(np.sort(np.stack((src[close], nbors[close]), axis=1), axis=1),
+                                 axis=0, return_index=True)
+        edges = np.column_stack((pairs, weights[close][first])).astype(np.float64)
+    else:
+        edges = np.empty((0, 3), dtype=np.float64)
 
+    inputs_path = plots.save_plot_inputs(f'{dest}{para}_{deg}_graph.png', 'node_graph',
+                                         labels=np.array([str(i) for i in labels]), edges=edges)
+    (renderer or plots.get_renderer()).submit(inputs_path)
+    return dict(zip(labels, centroids.numpy()))
 
-import math
 
+def class_centroids(X, T, nb_classes=None):
+    """
+    One pass scatter-mean of the rows of X per label of T.
+    Returns (l2 normalised centroids [nb_labels x sz_embedding], labels [nb_labels]) for the labels
+    that occur in T.
+    """
+    X = torch.as_tensor(X).float()
+    T = torch.as_tensor(np.asarray(T)).long()
+    nb_classes = int(T.max()) + 1 if nb_classes is None else nb_classes
+    sums = torch.zeros((nb_classes, X.shape[1])).index_add_(0, T, X)
+    counts = torch.bincount(T, minlength=nb_classes)
+    labels = torch.nonzero(counts).squeeze(dim=1)
+    return l2_normalize(sums[labels] / counts[labels, None]), labels.numpy()
 
-def cosine_similarity(v1, v2):
-    "compute cosine similarity of v1 to v2: (v1 dot v2)/{||v1||*||v2||)"
-    sumxx, sumxy, sumyy = 0, 0, 0
-    for i in range(len(v1)):
-        x = v1[i];
-        y = v2[i]
-        sumxx += x * x
-        sumyy += y * y
-        sumxy += x * y
-    return sumxy / math.sqrt(sumxx * sumyy)
-  
-
-def f1_score_calc(T, Y, dataloader, pictures_to_predict):
-    for k in [3, 5, 7]:
-        val_y_preds, val_y_true, metrics = calc_recall(T[pictures_to_predict], Y[pictures_to_predict],
-                                                       k, prepend=dataloader.dataset.mode + '_')
-    return metrics
+
+def nearest_class(X, class_vectors, class_labels=None, chunk_size=4096):
+    """
+    Label of the most cosine-similar class vector (proxy or centroid) for every row of X,
+    O(nb_samples x nb_classes) and only `chunk_size` rows of similarities at a time.
+    class_labels : label of every class vector, its row number by default
+    """
+    class_vectors = l2_normalize(class_vectors)
+    preds = np.zeros(len(X), dtype=np.int64)
+    for start in range(0, len(X), chunk_size):
+        sims = pairwise_similarity(X[start:start + chunk_size], class_vectors)
+        preds[start:start + len(sims)] = sims.argmax(dim=1).numpy()
+    return preds if class_labels is None else np.asarray(class_labels)[preds]
 
 
-def get_accuracies(T, X, dataloader, neighbors, pictures_to_predict, metrics):
+def get_class_predictions(T, X, dataloader, pictures_to_predict, metrics, proxies=None, knn_preds=None,
+                          chunk_size=4096):
+    """
+    Predicts every item of `pictures_to_predict` as its nearest class: nearest row of `proxies`
+    (row i standing for class i), or, without proxies, nearest centroid of the items that
+    aren't being predicted. Adds the same accuracies as get_accuracies and the weighted F1 under
+    `<mode>_proxy_...` / `<mode>_centroid_...`, plus how often it agrees with the kNN prediction
+    `knn_preds`.
+    """
+    T = np.asarray(T).astype(np.int64)
+    pictures_to_predict = np.asarray(pictures_to_predict)
     ground_truth = T[pictures_to_predict]
+    hierarchy = label_hierarchy(dataloader.dataset)
+
+    if proxies is not None:
+        source = 'proxy'
+        class_vectors, class_labels = torch.as_tensor(proxies).detach().cpu().float(), None
+    else:
+        source = 'centroid'
+        is_reference = np.ones(len(T), dtype=bool)
+        is_reference[pictures_to_predict] = False
+        class_vectors, class_labels = class_centroids(torch.as_tensor(X)[is_reference], T[is_reference])
 
-    coarse_filter_dict = dataloader.dataset.class_names_coarse_dict
-    fine_filter_dict = dataloader.dataset.class_names_fine_dict
+    y_preds = nearest_class(torch.as_tensor(X)[pictures_to_predict], class_vectors, class_labels, chunk_size)
 
+    coarse_predictions = hierarchy.encode(y_preds, 'coarse')
+    coarse_truth = hierarchy.encode(ground_truth, 'coarse')
+    prepend = f'{dataloader.dataset.mode}_{source}'
+    metrics[f'{prepend}_accuracy'] = accuracy_score(y_preds, ground_truth) * 100
+    metrics[f'{prepend}_coarse_accuracy'] = np.mean((coarse_predictions == coarse_truth) & (coarse_truth >= 0)) * 100
+    metrics[f'{prepend}_f1score'] = f1_score(ground_truth, y_preds, average='weighted') * 100
+    if knn_preds is not None:
+        metrics[f'{prepend}_knn_agreement'] = np.mean(y_preds == np.asarray(knn_preds)) * 100
+    return y_preds
 
-    y_preds = np.zeros(len(pictures_to_predict))
-    y_preds_mode = np.zeros(len(pictures_to_predict))
-    for idx, pic in tqdm(enumerate(pictures_to_predict), total=len(pictures_to_predict), desc='Accuracy Analysis'):
-        neighbors_to_pic = np.array(neighbors[pic, :][~np.in1d(neighbors[pic, :], pictures_to_predict)])
 
-        preds, counts = np.unique(T[neighbors_to_pic[0:7]], return_counts=True)
-        close_preds = preds[counts >= np.max(counts) - 1]
-        y_preds_mode[idx] = preds[np.argsort(counts)[-1]]
-        predictions = {}
+def cosine_similarity(v1, v2):
+    "compute cosine similarity of v1 to v2: (v1 dot v2)/{||v1||*||v2||)"
+    return pairwise_similarity(np.asarray(v1, dtype=np.float32)[None, :],
+                               np.asarray(v2, dtype=np.float32)[None, :]).item()
 
-        for close_pred in close_preds:
-            neighbors_pred = [i for i in neighbors_to_pic[0:7] if T[i] == close_pred]
-            one = np.array(X[neighbors_pred])
-            two = np.array(X[pic]).reshape(-1, 1).T
 
-            norms_X = np.sqrt((one * one).sum(axis=1))  # Or np.linalg.norm(axis=1)
-            one /= norms_X[:, np.newaxis]
-            norms_Y = np.sqrt((two * two).sum(axis=1))
-            two /= norms_Y[:, np.newaxis]
-            cs = np.dot(one, two.T)
+def f1_score_calc(T, Y, dataloader, pictures_to_predict, ks=(1, 3, 5, 7), query_rows=False):
+    # query_rows: Y only holds the rows of pictures_to_predict (get_X_T_Y with queries)
+    Y = Y if query_rows else Y[pictures_to_predict]
+    metrics, _ = retrieval_metrics(T[pictures_to_predict], Y, ks, T_gallery=T,
+                                   prepend=dataloader.dataset.mode + '_')
+    return metrics
 
-            predictions[close_pred] = (sum(cs) / np.sqrt(len(cs)))[0]
 
-        y_preds[idx] = max(predictions, key=predictions.get)
+def get_accuracies(T, X, dataloader, neighbors, pictures_to_predict, metrics, nb_votes=7, chunk_size=4096,
+                   query_rows=False, excluded=None):
+    """
+    Predicts every item of `pictures_to_predict` from its `nb_votes` nearest neighbours that are
+    not in `excluded` (pictures_to_predict by default, the whole set a sample of it is drawn from
+    to score the same as predicting the whole set). `neighbors` holds only the rows of
+    pictures_to_predict if `query_rows`. Two predictions are scored:
+        specific_mode : most frequent neighbour label (largest label on ties)
+        specific      : among labels within one vote of the most frequent, the one with the highest
+                        sum(cosine) / sqrt(nb_votes_for_label) (smallest label on ties)
+    """
+    T = np.asarray(T).astype(np.int64)
+    X = np.asarray(X, dtype=np.float32)
+    pictures_to_predict = np.asarray(pictures_to_predict)
+    ground_truth = T[pictures_to_predict]
 
-    ground_truth = np.array(ground_truth)
-    coarse_predictions = [coarse_filter_dict[pred] for pred in y_preds]
-    coarse_truth = [coarse_filter_dict[truth] for truth in ground_truth]
+    hierarchy = label_hierarchy(dataloader.dataset)
+
+    # keep the first nb_votes neighbours of every query that aren't excluded themselves
+    is_excluded = np.zeros(len(T), dtype=bool)
+    is_excluded[pictures_to_predict if excluded is None else excluded] = True
+    query_neighbors = np.asarray(neighbors) if query_rows else np.asarray(neighbors)[pictures_to_predict]
+    valid = ~is_excluded[query_neighbors]
+    first_valid = np.argsort(~valid, axis=1, kind='stable')[:, :nb_votes]
+    voters = np.take_along_axis(query_neighbors, first_valid, axis=1)
+    valid = np.take_along_axis(valid, first_valid, axis=1)
+    # queries without any valid neighbour fall back to their nearest neighbour
+    valid[~valid.any(axis=1), 0] = True
+
+    votes = T[voters]
+    same_label = (votes[:, :, None] == votes[:, None, :]) & valid[:, None, :] & valid[:, :, None]
+    counts = same_label.sum(axis=2)
+    max_counts = counts.max(axis=1, keepdims=True)
+
+    no_label = np.iinfo(np.int64).min
+    y_preds_mode = np.where(valid & (counts == max_counts), votes, no_label).max(axis=1)
+
+    # cosine similarity of every query to its voters
+    cs = np.zeros(voters.shape, dtype=np.float32)
+    for start in range(0, len(pictures_to_predict), chunk_size):
+        stop = start + chunk_size
+        cs[start:stop] = paired_similarity(X[pictures_to_predict[start:stop]], X[voters[start:stop]]).numpy()
+
+    close = valid & (counts >= max_counts - 1)
+    scores = (same_label * cs[:, None, :]).sum(axis=2) / np.sqrt(np.maximum(counts, 1))
+    scores = np.where(close, scores, -np.inf)
+    best = close & (scores == scores.max(axis=1, keepdims=True))
+    y_preds = np.where(best, votes, np.iinfo(np.int64).max).min(axis=1)
+
+    coarse_predictions = hierarchy.encode(y_preds, 'coarse')
+    coarse_truth = hierarchy.encode(ground_truth, 'coarse')
 
     metrics[f'{dataloader.dataset.mode}_specific_accuracy'] = accuracy_score(y_preds, ground_truth) * 100
     metrics[f'{dataloader.dataset.mode}_specific_mode_accuracy'] = accuracy_score(y_preds_mode, ground_truth) * 100
-    metrics[f'{dataloader.dataset.mode}_coarse_accuracy'] = accuracy_score(coarse_predictions, coarse_truth) * 100
-
-    tally_true = dict(Counter(y_preds))
-    for key, val in sorted(dict(Counter(y_preds)).items()):
-        pred_fac = np.round(100 * val / len(pictures_to_predict), 2)
-        true_fac = np.round(100 * tally_true[key] / len(pictures_to_predict), 2)
-        if abs(pred_fac - true_fac) > 3:
-            print(f'{int(key)}: pred: {val} - {pred_fac}% vs true: {true_fac}%')
-
-    return coarse_filter_dict, fine_filter_dict, y_preds, ground_truth
+    metrics[f'{dataloader.dataset.mode}_coarse_accuracy'] = \
+        np.mean((coarse_predictions == coarse_truth) & (coarse_truth >= 0)) * 100
 
+    return hierarchy, y_preds, ground_truth